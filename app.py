@@ -1,18 +1,28 @@
 # System imports:
+import io
 import os
 import re
+import csv
+import json
+import heapq
 import time
+import threading
 import logging
 from functools import wraps
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from typing import Iterator, Optional
 
 # Third-party imports:
-from flask import Flask, request, render_template, session, redirect, url_for, abort, jsonify, send_from_directory
+import click
+from flask import (Flask, request, render_template, session, redirect, url_for, abort, jsonify, send_from_directory, g,
+                   Response, stream_with_context)
 from werkzeug.utils import secure_filename
 
 # Local imports:
-from database import UserDB, RestaurantsDB, FoodItemsDB, CartDB, OrdersDB, ContactFormResponsesDB, ReviewsDB
-from utils import send_email, ORS
+from database import (UserDB, RestaurantsDB, FoodItemsDB, CartDB, OrdersDB, ContactFormResponsesDB, ReviewsDB,
+                      run_migrations, find_table_scans, transaction)
+from utils import ORS, HashingBusyError, hash_password, address_index, autocomplete_address
+from outbox import queue_email, EmailWorker
 from config import *
 from secret_config import FLASK_SECRET_KEY, GOOGLE_API_KEY
 
@@ -22,6 +32,99 @@ app.config['MAX_CONTENT_LENGTH'] = 8 * 1000 * 1000  # Limiting uploads to 8 mega
 
 logging.basicConfig(filename='FoodShare.log', level=logging.INFO, format='%(asctime)s %(levelname)s : %(message)s')
 
+if RUN_MIGRATIONS_ON_STARTUP:  # Set up/upgrade the database once per process, rather than on every request
+    for migration in run_migrations():
+        logging.info(f"Applied database migration {migration}")
+
+_email_worker_pid = None  # The process the email worker was started in, as a forked process does not inherit it
+_email_worker_lock = threading.Lock()
+
+
+@app.before_request
+def start_email_worker():
+    """ Starts the email worker of this process with the first request it serves, so CLI commands never start one """
+    global _email_worker_pid
+    if EMAIL_WORKER_ENABLED and _email_worker_pid != os.getpid():
+        with _email_worker_lock:
+            if _email_worker_pid != os.getpid():
+                EmailWorker().start()
+                _email_worker_pid = os.getpid()
+
+
+@app.cli.command("migrate")
+def migrate_database():
+    """ Applies any pending database migrations (flask migrate) """
+    applied = run_migrations()
+    for migration in applied:
+        print(f"Applied {migration}")
+    if not applied:
+        print("The database is already up to date.")
+
+
+@app.cli.command("check-indexes")
+def check_indexes():
+    """ Fails if any of the database lookups would scan a whole table (flask check-indexes) """
+    scans = find_table_scans()
+    for scan in scans:
+        print(scan)
+    if scans:
+        raise SystemExit(1)
+    print("All lookups use an index.")
+
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups():
+    """ Recomputes the seller analytics rollups from the orders table (flask rebuild-rollups) """
+    OrdersDB().rebuild_rollups()
+    print("Rebuilt the sales rollups. Cancellation counts were kept, as cancelled orders are not stored.")
+
+
+@app.cli.command("bench-login")
+@click.option("--logins", default=200, help="Number of logins to simulate.")
+@click.option("--threads", default=16, help="Number of logins made at the same time.")
+def bench_login(logins: int, threads: int):
+    """ Measures how many password checks per second the server can do with the current KDF (flask bench-login) """
+    salt = os.urandom(64)
+    hash_password("warm-up", salt)  # Start the hashing processes before timing
+    remaining = iter(range(logins))
+    lock = threading.Lock()
+    rejected = 0
+
+    def login():
+        nonlocal rejected
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            try:
+                hash_password("Password123!", salt)
+            except HashingBusyError:
+                with lock:
+                    rejected += 1
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=login) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    print(f"{PASSWORD_KDF}: {logins - rejected} logins in {elapsed:.2f}s ({(logins - rejected) / elapsed:.1f}/s) "
+          f"with {PASSWORD_HASH_WORKERS} hashing processes, {rejected} turned away as busy")
+
+
+@app.cli.command("send-emails")
+def send_emails():
+    """ Sends queued emails until interrupted, for running the email worker as its own process (flask send-emails) """
+    worker = EmailWorker()
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(1)
+    except KeyboardInterrupt:
+        worker.stop()
+        worker.join()
+
 
 @app.template_filter()
 def format_date(epoch_time: int) -> str:
@@ -35,10 +138,38 @@ def format_datetime(epoch_time: int) -> str:
     return datetime.fromtimestamp(epoch_time).strftime('%d %b %Y, %I:%M %p')
 
 
+# Identity map of the users already loaded during the current request, so that templates referring to the same
+# user many times only cause a single query.
+
+def prefetch_users(userids) -> None:
+    """ Loads all the given users into the request's identity map in one query """
+    g.setdefault('users', {})
+    missing = {userid for userid in userids if userid not in g.users}
+    g.users.update(UserDB().get_users(list(missing)))
+
+
 @app.template_filter()
 def fetch_user(userid: int):
     """ Returns the user with the given userid for use in the html templates """
-    return UserDB().get_user(userid=userid)
+    if userid not in g.get('users', {}):
+        prefetch_users([userid])
+    return g.users.get(userid)
+
+
+def parse_cursor() -> Optional[tuple[int, int]]:
+    """ Returns the (time, id) cursor from the 'before' query parameter of a paginated page, or None for the first page """
+    if cursor := request.args.get('before'):
+        if not re.fullmatch(r"\d+-\d+", cursor):
+            abort(400)
+        return tuple(int(part) for part in cursor.split("-"))
+    return None
+
+
+def next_cursor(rows: list[dict], time_field: str, id_field: str) -> Optional[str]:
+    """ Returns the cursor for the page after the given full page of rows, or None if this is the last page """
+    if len(rows) < PAGE_SIZE:
+        return None
+    return f"{int(rows[-1][time_field])}-{rows[-1][id_field]}"
 
 
 # Decorator function for pages requiring a login
@@ -122,7 +253,7 @@ def sign_up_page():
                                      request.form['address'],
                                      coordinates[0], coordinates[1], request.form['password'])
                 message = WELCOME_TEMPLATE.format(fname=request.form['fname'])
-                send_email("Welcome to FoodShare", message, COMMS_EMAIL, [request.form['email']])
+                queue_email("Welcome to FoodShare", message, COMMS_EMAIL, [request.form['email']])
                 # Sign the user in and redirect to the dashboard
                 session['email'] = request.form['email']
                 session['userid'] = userid
@@ -148,7 +279,7 @@ def reset_password_page():
         reset_id = db.generate_reset_id(request.form['email'])
         link = f"{WEBSITE_BASE_URL}/reset_password/{reset_id}"
         content = RESET_PASSWORD_TEMPLATE.format(fname=user['fname'], link=link, SUPPORT_EMAIL=SUPPORT_EMAIL)
-        send_email("Reset your password", content, COMMS_EMAIL, [request.form['email']])
+        queue_email("Reset your password", content, COMMS_EMAIL, [request.form['email']])
         return render_template("change_reset_password.html", stage=2)  # Message informing user to check their email
 
 
@@ -172,7 +303,7 @@ def reset_password(reset_id: int):
         db.edit_user(user['email'], unhashed_password=request.form['password'])  # Change the password
         db.delete_reset_id(reset_id)
         message = RESET_PASSWORD_NOTIFICATION.format(fname=user['fname'], SUPPORT_EMAIL=SUPPORT_EMAIL)
-        send_email("Your password has been reset", message, COMMS_EMAIL, [user['email']])  # Notify the user by email
+        queue_email("Your password has been reset", message, COMMS_EMAIL, [user['email']])  # Notify the user by email
         session['email'] = user['email']  # Sign the user in
         session['userid'] = user['userid']
         return redirect(url_for("buyer_dashboard", alert="Your password has been successfully changed."))
@@ -185,10 +316,10 @@ def change_password():
         return render_template("change_reset_password.html", alert=request.args.get("alert"), change_password=True)
     else:  # Form submitted
         db = UserDB()
-        user = db.get_user(session['email'])
+        user = db.get_profile(session['userid'])
         db.edit_user(user['email'], unhashed_password=request.form['password'])
         message = CHANGE_PASS_NOTIF.format(fname=user['fname'], SUPPORT_EMAIL=SUPPORT_EMAIL)
-        send_email("Your password has been changed", message, COMMS_EMAIL, [user['email']])  # Notify the user by email
+        queue_email("Your password has been changed", message, COMMS_EMAIL, [user['email']])  # Notify the user by email
         return redirect(url_for("change_password", alert="Your password has been changed."), code=303)
 
 
@@ -208,18 +339,27 @@ def contact_us():
         message = CONTACT_US_RESPONSE.format(fname=request.form['fname'], lname=request.form['lname'],
                                              email=request.form['email'], message=request.form['message'],
                                              nature=request.form['nature'])
-        send_email(f"New {request.form['nature'].lower()} from FoodShare", message, COMMS_EMAIL, [SUPPORT_EMAIL])
+        queue_email(f"New {request.form['nature'].lower()} from FoodShare", message, COMMS_EMAIL, [SUPPORT_EMAIL])
 
         return render_template("contact_us.html", signed_in=bool(session.get('email')),
                                alert="Your message has been sent. We will get back to you shortly.")
 
 
+def known_addresses():
+    """ Yields the address and coordinates of every restaurant, to seed the autocomplete index.
+
+    Users' addresses must never be added, as the index is served to anyone, logged in or not.
+    """
+    for restaurant in RestaurantsDB().get_all_restaurants():
+        yield restaurant['address'], [restaurant['longitude'], restaurant['latitude']]
+
+
 @app.route('/autocomplete/address', methods=['GET'])
 def address_autocomplete():
     # Provides autocomplete details to the frontend
     if address := request.args.get("address", None):  # Check if the request is valid
-        api = ORS()
-        return jsonify(api.autocomplete_coordinates(address))
+        address_index.seed_once(known_addresses)
+        return jsonify(autocomplete_address(address))
     else:
         abort(400)
 
@@ -228,17 +368,22 @@ def address_autocomplete():
 @login_required
 def buyer_dashboard():
     udb = UserDB()
-    user = udb.get_user(session['email'])
+    user = udb.get_profile(session['userid'])
     rdb = RestaurantsDB()
-    restaurants = rdb.get_all_restaurants()
-    api = ORS()
     user_coords = (user['longitude'], user['latitude'])
-    for restaurant in restaurants:
-        #  Calculate distance between user and restaurant
-        restaurant_coords = (restaurant['longitude'], restaurant['latitude'])
-        distance = api.distance_between(user_coords, restaurant_coords)
-        restaurant['distance'] = distance
-    restaurants = sorted(restaurants, key=lambda restaurant: restaurant['distance'])  # Sort restaurants by distance
+    # Sort all restaurants by straight-line distance in one pass, then only ask ORS for the walking distance of the
+    # nearest few, which are the ones the user is most likely to order from.
+    restaurants = rdb.get_restaurants_by_distance(user_coords)
+    closest, others = restaurants[:WALKING_DISTANCE_RESULTS], restaurants[WALKING_DISTANCE_RESULTS:]
+    api = ORS()
+    walking = api.distance_matrix(user_coords, [(restaurant['longitude'], restaurant['latitude']) for restaurant in closest])
+    for restaurant, distance in zip(closest, walking):
+        if distance is not None:  # Keep the straight-line distance if ORS could not find a walking route
+            restaurant['distance'] = distance
+    # A walking distance may be longer than the straight-line distance of the next restaurants, so the two sorted
+    # lists are merged to keep the whole list in order of the distance shown
+    closest.sort(key=lambda restaurant: restaurant['distance'])
+    restaurants = list(heapq.merge(closest, others, key=lambda restaurant: restaurant['distance']))
     return render_template("buyer_dashboard.html", restaurants=restaurants, alert=request.args.get('alert', None))
 
 
@@ -248,7 +393,7 @@ def view_restaurant(restid: int):
     rdb = RestaurantsDB()
     restaurant = rdb.view_restaurant(restid=restid)
     udb = UserDB()
-    user = udb.get_user(session['email'])
+    user = udb.get_profile(session['userid'])
     api = ORS()
     restaurant_coords = (restaurant['longitude'], restaurant['latitude'])
     user_coords = (user['longitude'], user['latitude'])
@@ -264,6 +409,21 @@ def view_restaurant(restid: int):
 @login_required
 def update_cart():
     cdb = CartDB()
+    if request.is_json:  # A batch of {itemid: change in quantity}, from the clicks the user made in quick succession
+        try:
+            changes = {int(itemid): int(delta) for itemid, delta in request.get_json().items()}
+            if any(abs(delta) > 99 for delta in changes.values()):
+                raise ValueError("Too large a change in quantity.")
+        except (AttributeError, TypeError, ValueError):
+            abort(400)
+        try:
+            cart = cdb.apply_changes(session['userid'], changes)
+        except ValueError:
+            # Signal to frontend that the request was invalid, along with the unchanged cart to show instead
+            cart = {item['itemid']: item['quantity'] for item in cdb.fetch_cart(session['userid'])}
+            return jsonify(cart=cart), 400
+        return jsonify(cart=cart)
+
     try:
         if request.form['action'] == 'increment':  # User clicked the "+" button
             cdb.increment_item(session['userid'], int(request.form['itemid']))
@@ -278,20 +438,9 @@ def update_cart():
 @app.route("/cart/view", methods=['GET'])
 @login_required
 def view_cart():
-    rdb = RestaurantsDB()
-    cdb = CartDB()
-    cart = cdb.fetch_cart(session['userid'])
+    cart = CartDB().fetch_cart_detailed(session['userid'])
     if cart:
-        restaurant = rdb.view_restaurant(restid=cart[0]['restid'])
-        fdb = FoodItemsDB()
-        items = []
-        for item in cart:
-            details = fdb.get_item(item['itemid'])
-            details['quantity'] = item['quantity']
-            details['total'] = round(details['quantity'] * details['price'], 2)
-            items.append(details)
-        total = sum(item['total'] for item in items)
-        return render_template("cart.html", cart=items, total=total, restaurant=restaurant,
+        return render_template("cart.html", cart=cart['items'], total=cart['total'], restaurant=cart['restaurant'],
                                alert=request.args.get('alert'))
     else:
         return render_template("cart.html", cart=[])
@@ -302,41 +451,39 @@ def view_cart():
 def submit_cart():
     if request.form['action'] == 'checkout':  # User clicked the "Checkout" button
         cdb = CartDB()
-        cart = cdb.fetch_cart(session['userid'])
-        rdb = RestaurantsDB()
-        restaurant = rdb.view_restaurant(restid=cart[0]['restid'])
-
-        if not restaurant['open']:  # If the restaurant is not accepting new orders
-            return redirect(url_for('view_cart',
-                                    alert="Your order was not sent, as the restaurant is currently not accepting new orders. Please try again later."))
-
-        fdb = FoodItemsDB()
-        items = []
-        for item in cart:
-            details = fdb.get_item(item['itemid'])
-            details['quantity'] = item['quantity']
-            details['total'] = round(details['quantity'] * details['price'], 2)
-            items.append(details)
-        amount = sum(item['total'] for item in items)
-
-        #  Process order:
         odb = OrdersDB()
-        orderid = odb.create_order(session['userid'], restaurant['restid'], items, amount)
-        cdb.clear_cart(session['userid'])
+        # The cart is read, ordered and cleared in one transaction, with the cart locked so that changes made from
+        # another tab wait until the order has been placed
+        with transaction():
+            cart = cdb.fetch_cart_detailed(session['userid'], lock=True)
+            if not cart:  # Nothing to order, e.g. the cart was checked out from another tab
+                return redirect(url_for('view_cart'))
+            restaurant = cart['restaurant']
+
+            if not restaurant['open']:  # If the restaurant is not accepting new orders
+                return redirect(url_for('view_cart',
+                                        alert="Your order was not sent, as the restaurant is currently not accepting new orders. Please try again later."))
+
+            items = cart['items']
+            amount = cart['total']
+
+            #  Process order:
+            orderid = odb.create_order(session['userid'], restaurant['restid'], items, amount)
+            cdb.clear_cart(session['userid'])
 
         #  Send emails to buyer and seller:
         udb = UserDB()
-        buyer = udb.get_user(session['email'])
-        seller = udb.get_user(userid=restaurant['userid'])
+        buyer = udb.get_profile(session['userid'])
+        seller = udb.get_profile(restaurant['userid'])
 
         buyer_message = ORDER_CONFIRM_BUYER.format(orderid=orderid, fname=buyer['fname'],
                                                    link=url_for('buyer_orders', _external=True))
-        send_email(f"Order Confirmation #{orderid} at {restaurant['name']}", buyer_message, COMMS_EMAIL, [session['email']])
+        queue_email(f"Order Confirmation #{orderid} at {restaurant['name']}", buyer_message, COMMS_EMAIL, [session['email']])
 
         seller_message = ORDER_CONFIRM_SELLER.format(orderid=orderid, fname=seller['fname'],
                                                      link=url_for('seller_dashboard', _external=True),
                                                      buyer=buyer['fname'], amount=round(amount, 2))
-        send_email(f"New Order #{orderid} by {buyer['fname']} {buyer['lname']}", seller_message, COMMS_EMAIL, [seller['email']])
+        queue_email(f"New Order #{orderid} by {buyer['fname']} {buyer['lname']}", seller_message, COMMS_EMAIL, [seller['email']])
 
         return redirect(url_for('buyer_orders', alert=f"Your order at {restaurant['name']} for ${amount} has been placed!"))
     elif request.form['action'] == 'clear':  # User clicked "Clear Cart"
@@ -369,6 +516,7 @@ def setup_restaurant():
 
         api = ORS()
         coordinates = api.get_coordinates(request.form['address'])
+        address_index.add(request.form['address'], coordinates)  # Restaurant addresses are public, for autocomplete
 
         rdb.add_restaurant(session['userid'], request.form['name'], request.form['address'], coordinates[0],
                            coordinates[1], coverpic)
@@ -381,16 +529,83 @@ def seller_dashboard():
     rdb = RestaurantsDB()
     if restaurant := rdb.get_restaurant(userid=session['userid']):  # User has set up their restaurant
         odb = OrdersDB()
-        orders = odb.fetch_rest_orders(restaurant['restid'])
-        udb = UserDB()
+        # All pending orders are shown oldest first, but fulfilled orders are shown a page at a time, newest first
+        pending = odb.fetch_rest_orders_with_buyers(restaurant['restid'], status=['Preparing', 'Ready'])[::-1]
+        fulfilled = odb.fetch_rest_orders_with_buyers(restaurant['restid'], status='Collected', before=parse_cursor(),
+                                                      limit=PAGE_SIZE)
+        next_page = next_cursor(fulfilled, 'ordertime', 'orderid')
+        orders = pending + fulfilled
         for order in orders:
             order['restaurant'] = restaurant
             order['date'] = datetime.fromtimestamp(order['ordertime']).strftime("%d %b %Y")
             order['time'] = datetime.fromtimestamp(order['ordertime']).strftime("%I:%M %p")
-            order['buyer'] = udb.get_user(userid=order['userid'])
-        return render_template("seller_dashboard.html", orders=orders, restaurant=restaurant)
+        return render_template("seller_dashboard.html", orders=orders, restaurant=restaurant, next_page=next_page)
+    else:
+        return redirect(url_for("setup_restaurant"))
+
+
+EXPORT_FIELDS = ['orderid', 'ordertime', 'orderstatus', 'amount', 'buyer_fname', 'buyer_lname', 'buyer_email', 'items']
+
+
+def export_csv(orders: Iterator[dict]) -> Iterator[str]:
+    """ Generates a CSV file of the given orders in chunks of roughly 64KB """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for order in orders:
+        order['ordertime'] = datetime.fromtimestamp(order['ordertime']).strftime('%Y-%m-%d %H:%M:%S')
+        order['items'] = json.dumps(order['items'])
+        writer.writerow([order[field] for field in EXPORT_FIELDS])
+        if buffer.tell() >= 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_ndjson(orders: Iterator[dict]) -> Iterator[str]:
+    """ Generates a newline-delimited JSON file of the given orders, one order per line """
+    for order in orders:
+        order['ordertime'] = datetime.fromtimestamp(order['ordertime']).strftime('%Y-%m-%d %H:%M:%S')
+        order['amount'] = float(order['amount'])
+        yield json.dumps({field: order[field] for field in EXPORT_FIELDS}) + "\n"
+
+
+@app.route("/seller/orders/export", methods=['GET'])
+@login_required
+def export_orders():
+    rdb = RestaurantsDB()
+    if not (restaurant := rdb.get_restaurant(userid=session['userid'])):
+        return redirect(url_for("setup_restaurant"))
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        abort(400)
+
+    # Orders are streamed from the database straight into the response, so the whole history is never held in memory
+    orders = OrdersDB().stream_rest_orders(restaurant['restid'])
+    if export_format == 'csv':
+        body, mimetype = export_csv(orders), 'text/csv'
     else:
+        body, mimetype = export_ndjson(orders), 'application/x-ndjson'
+    filename = f"orders-{restaurant['restid']}-{datetime.now().strftime('%Y%m%d')}.{export_format}"
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@app.route("/seller/analytics", methods=['GET'])
+@login_required
+def seller_analytics():
+    rdb = RestaurantsDB()
+    if not (restaurant := rdb.get_restaurant(userid=session['userid'])):
         return redirect(url_for("setup_restaurant"))
+    odb = OrdersDB()
+    since = (date.today() - timedelta(days=ANALYTICS_DAYS - 1)).isoformat()
+    # Only the daily rollups are read, so this page stays quick however many orders the restaurant has
+    days = odb.fetch_daily_sales(restaurant['restid'], since)
+    items = odb.fetch_item_sales(restaurant['restid'], since)
+    totals = {field: sum(day[field] for day in days) for field in ('orders', 'revenue', 'collected', 'cancellations')}
+    return render_template("seller_analytics.html", restaurant=restaurant, days=days, items=items, totals=totals,
+                           period=ANALYTICS_DAYS)
 
 
 @app.route("/orders/toggle", methods=['POST'])
@@ -410,10 +625,10 @@ def mark_order_ready():
     odb = OrdersDB()
     order = odb.fetch_order(orderid)
     udb = UserDB()
-    buyer = udb.get_user(userid=order['userid'])
+    buyer = udb.get_profile(order['userid'])
     if order['restid'] == restaurant['restid']:
         odb.mark_ready(orderid)  # Marks the order as ready in the database
-        send_email(f"Order #{orderid} is ready for pickup",
+        queue_email(f"Order #{orderid} is ready for pickup",
                    ORDER_READY_FOR_COLLECTION.format(orderid=orderid, fname=buyer['fname'],
                                                      restaurant=restaurant['name'], address=restaurant['address']),
                    COMMS_EMAIL, [buyer['email']])  # Inform user that order is ready for pickup
@@ -447,17 +662,17 @@ def cancel_order():
     udb = UserDB()
 
     if order['userid'] == session['userid']:  # Order is being cancelled by the buyer
-        buyer = udb.get_user(email=session['email'])
+        buyer = udb.get_profile(session['userid'])
         odb.cancel_order(orderid=int(request.form['orderid']))
-        send_email(f"Order #{request.form['orderid']} Cancelled",
+        queue_email(f"Order #{request.form['orderid']} Cancelled",
                    ORDER_CANCELLED_BY_BUYER.format(orderid=request.form['orderid'],
                                                    buyer=buyer['fname'] + " " + buyer['lname']),
                    COMMS_EMAIL, [session['email']])
         return "Successful", 200
     elif session['userid'] == restaurant['userid']:  # Order is being cancelled by the seller
-        buyer = udb.get_user(userid=order['userid'])
+        buyer = udb.get_profile(order['userid'])
         odb.cancel_order(orderid=int(request.form['orderid']))
-        send_email(f"Order #{request.form['orderid']} Cancelled",
+        queue_email(f"Order #{request.form['orderid']} Cancelled",
                    ORDER_CANCELLED_BY_SELLER.format(orderid=request.form['orderid'], restaurant=restaurant['name']),
                    COMMS_EMAIL, [buyer['email']])
         return "Successful", 200
@@ -473,11 +688,12 @@ def generate_invoice(orderid: int):
     rdb = RestaurantsDB()
     restaurant = rdb.get_restaurant(restid=order['restid'])
     udb = UserDB()
-    user = udb.get_user(userid=order['userid'])
+    user = udb.get_profile(order['userid'])
     # Check if the user logged-in is either the buyer or seller
     if restaurant['userid'] == session['userid'] or user['userid'] == session['userid']:
         order['date'] = datetime.fromtimestamp(order['ordertime']).strftime("%d %b %Y")
         order['time'] = datetime.fromtimestamp(order['ordertime']).strftime("%I:%M %p")
+        order['items'] = odb.fetch_order_items(orderid)
         return render_template("invoice.html", order=order, restaurant=restaurant, buyer=user)
     else:
         return "Unauthorized", 401
@@ -487,17 +703,15 @@ def generate_invoice(orderid: int):
 @login_required
 def buyer_orders():
     odb = OrdersDB()
-    orders = odb.fetch_user_orders(session['userid'])
-    reviewdb = ReviewsDB()
-    reviews = reviewdb.fetch_user_reviews(session['userid'])
-    reviews = {review['orderid']: review['stars'] for review in reviews}
-    rdb = RestaurantsDB()
+    pending = odb.fetch_user_orders_detailed(session['userid'], status=['Preparing', 'Ready'])
+    completed = odb.fetch_user_orders_detailed(session['userid'], status='Collected', before=parse_cursor(),
+                                               limit=PAGE_SIZE)
+    next_page = next_cursor(completed, 'ordertime', 'orderid')
+    orders = pending + completed
     for order in orders:
-        order['restaurant'] = rdb.get_restaurant(restid=order['restid'])
         order['date'] = datetime.fromtimestamp(order['ordertime']).strftime("%d %b %Y")
         order['time'] = datetime.fromtimestamp(order['ordertime']).strftime("%I:%M %p")
-        order['review'] = reviews.get(order['orderid'], None)  # "None" if the user has not reviewed the order yet.
-    return render_template("buyer_orders.html", orders=orders)
+    return render_template("buyer_orders.html", orders=orders, next_page=next_page)
 
 
 @app.route("/reviews/add", methods=['POST'])
@@ -507,26 +721,36 @@ def add_review():
     stars = int(request.form['stars'])
     title = request.form['title']
     description = request.form['description']
-    order = OrdersDB().fetch_order(orderid)
-    if order['userid'] == session['userid']:
-        reviewdb = ReviewsDB()
-        reviewdb.add_review(orderid, stars, title, description)
-        return 'Successful', 200
-    else:
-        return 'Unauthorized', 401
+    if not 1 <= stars <= 5:
+        abort(400)
+    with transaction():  # The order is checked and the review added on one connection, with a single commit
+        order = OrdersDB().fetch_order(orderid)
+        if order['userid'] == session['userid']:
+            reviewdb = ReviewsDB()
+            try:
+                reviewdb.add_review(orderid, stars, title, description)
+            except ValueError:  # The order has already been reviewed
+                return 'Already reviewed', 409
+            return 'Successful', 200
+        else:
+            return 'Unauthorized', 401
 
 
 @app.route("/reviews/view/<int:restid>", methods=['GET'])
 @login_required
 def view_reviews(restid: int):
     reviewdb = ReviewsDB()
-    reviews = reviewdb.fetch_rest_reviews(restid)
+    reviews = reviewdb.fetch_rest_reviews(restid, before=parse_cursor(), limit=PAGE_SIZE)
+    next_page = next_cursor(reviews, 'submittedat', 'reviewid')
+    prefetch_users(review['userid'] for review in reviews)  # The template shows the name of each reviewer
     rdb = RestaurantsDB()
     restaurant = rdb.get_restaurant(restid=restid)
     if restaurant['userid'] == session['userid']:  # If the user is the owner of the restaurant
-        return render_template("reviews.html", reviews=reviews, restaurant=restaurant, is_owner=True)
+        return render_template("reviews.html", reviews=reviews, restaurant=restaurant, is_owner=True,
+                               next_page=next_page)
     else:
-        return render_template("reviews.html", reviews=reviews, restaurant=restaurant, is_owner=False)
+        return render_template("reviews.html", reviews=reviews, restaurant=restaurant, is_owner=False,
+                               next_page=next_page)
 
 
 @app.route("/restaurant/edit", methods=['GET', 'POST'])
@@ -543,6 +767,7 @@ def edit_restaurant():
     else:  # User has submitted the form
         api = ORS()
         coordinates = api.get_coordinates(request.form['address'])
+        address_index.add(request.form['address'], coordinates)  # Restaurant addresses are public, for autocomplete
         restaurant = {'name': request.form['name'], 'address': request.form['address'], 'longitude': coordinates[0],
                       'latitude': coordinates[1]}
 
@@ -671,6 +896,14 @@ def page_not_found(error):
     return {'error': 404, 'name': 'Page not Found', 'description': 'The page you requested could not be found.'}
 
 
+@app.errorhandler(503)
+@app.errorhandler(HashingBusyError)
+@error_page
+def service_unavailable(error):
+    return {'error': 503, 'name': 'Service Unavailable',
+            'description': 'We are experiencing a high volume of requests. Please try again in a moment.'}
+
+
 @app.errorhandler(500)
 @error_page
 def internal_server_error(error):
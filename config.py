@@ -4,6 +4,60 @@ ALLOWED_FILE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
 EMAIL_REGEX = '^[a-z0-9]+[\._]?[a-z0-9]+[@]\w+[.]\w{2,3}$'  # Regex for email validation
 UPLOADS_FOLDER = "uploads"
 
+PASSWORD_KDF = "pbkdf2_sha256$100000"  # KDF used for new hashes, e.g. "pbkdf2_sha256$<iterations>" or "scrypt$<n>$<r>$<p>"
+PASSWORD_HASH_WORKERS = 2  # Processes which hash passwords, so that logins do not block the web server's threads
+PASSWORD_HASH_QUEUE_DEPTH = 32  # Hashes waiting for a process before further logins are turned away
+
+PROFILE_CACHE_SIZE = 10000  # User profiles (name, email, address) kept in memory per process
+PROFILE_CACHE_TTL = 300  # Seconds before a cached profile is reloaded, in case another process changed it
+MENU_CACHE_SIZE = 500  # Restaurant menus kept in memory per process
+
+MYSQL_HOST = "localhost"
+MYSQL_DATABASE = "foodshare"
+MIGRATIONS_FOLDER = "migrations"
+RUN_MIGRATIONS_ON_STARTUP = True  # Otherwise, run "flask migrate" before starting the app
+MYSQL_POOL_SIZE = 10  # Maximum number of open MySQL connections per process
+MYSQL_POOL_TIMEOUT = 5  # Seconds to wait for a free connection before giving up
+MYSQL_POOL_PING_AFTER = 30  # Seconds a pooled connection may sit idle before it is checked to still be open
+STREAM_BATCH_SIZE = 1000  # Rows read from MySQL at a time when streaming large results, e.g. order exports
+STREAM_WRITE_TIMEOUT = 600  # Seconds MySQL waits for a slow consumer of a streamed result before aborting it
+STREAM_MAX_CONNECTIONS = 2  # Streamed results (e.g. order exports) run at once per process, on top of the pool
+
+CACHE_PATH = "cache.sqlite3"  # On-disk cache of ORS results, shared by all worker processes
+CACHE_MAX_ENTRIES = 100000  # Least recently used entries are evicted beyond this
+CACHE_TTL = 60 * 60 * 24 * 30  # Seconds before a cached ORS result expires (30 days)
+CACHE_COORDINATE_DECIMALS = 5  # Coordinates are rounded to this many decimal places (about 1 metre) in cache keys
+
+ORS_BASE_URL = "https://api.openrouteservice.org"
+ORS_MATRIX_MAX_LOCATIONS = 50  # Maximum locations (origin included) sent in a single ORS matrix request
+ORS_MAX_CONCURRENT_REQUESTS = 4
+ORS_CONNECT_TIMEOUT = 3.05  # Seconds
+ORS_READ_TIMEOUT = 10  # Seconds
+ORS_MAX_RETRIES = 3  # Retries of a request that failed with a connection error, 429 or 5xx
+ORS_BACKOFF = 0.5  # Base delay in seconds between retries, doubled (with random jitter) after each retry
+ORS_REQUEST_BUDGET = 12  # Seconds a request may take in total, retries and backoff included, as users wait on it
+ORS_CIRCUIT_FAILURES = 5  # Consecutive failed requests after which ORS is not contacted for a while
+ORS_CIRCUIT_RESET = 30  # Seconds before ORS is tried again after the circuit has opened
+AUTOCOMPLETE_RESULTS = 5  # Suggestions given for an address, answered locally when enough known addresses match
+AUTOCOMPLETE_INDEX_MAX_ENTRIES = 100000  # Addresses kept in the local autocomplete index per process
+WALKING_DISTANCE_RESULTS = 5  # Nearest restaurants on the dashboard whose walking distance is fetched from ORS (0 to disable)
+PAGE_SIZE = 50  # Orders/reviews shown per page, older ones are reached through the "Older" link
+ANALYTICS_DAYS = 30  # Days of daily sales shown on the seller analytics page
+
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 465
+SMTP_USE_SSL = True  # Set to False (with SMTP_LOGIN = False) to send to a local SMTP sink when testing
+SMTP_LOGIN = True
+EMAIL_WORKER_ENABLED = True  # Send queued emails from a thread of each process serving requests (otherwise run "flask send-emails")
+EMAIL_BATCH_SIZE = 20  # Emails claimed from the outbox at a time
+EMAIL_POLL_INTERVAL = 5  # Seconds between checks of the outbox when it is empty
+EMAIL_MAX_ATTEMPTS = 5  # Failed sends before an email is marked as dead
+EMAIL_RETRY_DELAY = 30  # Seconds before the first retry of a failed email, doubled after each attempt
+EMAIL_CLAIM_TIMEOUT = 300  # Seconds after which an email claimed by a worker that died is sent by another one
+EMAIL_SMTP_IDLE_TIMEOUT = 60  # Seconds the SMTP connection is kept open without anything to send
+EMAIL_SENT_RETENTION = 7 * 24 * 60 * 60  # Seconds sent emails are kept in the outbox before being deleted
+EMAIL_PURGE_INTERVAL = 60 * 60  # Seconds between deletions of old sent emails by each worker
+
 COMMS_EMAIL = "FoodShare31@gmail.com"
 SUPPORT_EMAIL = "FoodShare31@gmail.com"
 
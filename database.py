@@ -1,31 +1,447 @@
 # System imports:
-import json
+import importlib.util
+import itertools
 import os
+import queue
 import random
+import threading
 import time
-from typing import Union
+import uuid
+from contextlib import contextmanager
+from typing import Union, Iterator
 
 # Third-party imports:
 import mysql.connector
+from mysql.connector.errors import PoolError
 
 # Local imports:
-from utils import hash_password
+from utils import hash_password, verify_password, needs_rehash, LRUCache, DistanceIndex
 from secret_config import MYSQL_DB_USERNAME, MYSQL_DB_PASSWORD
-from config import UPLOADS_FOLDER
+from config import (PASSWORD_KDF, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, MENU_CACHE_SIZE, UPLOADS_FOLDER, MYSQL_HOST,
+                    MYSQL_DATABASE, MYSQL_POOL_SIZE, MYSQL_POOL_TIMEOUT, MYSQL_POOL_PING_AFTER, MIGRATIONS_FOLDER,
+                    STREAM_BATCH_SIZE, STREAM_WRITE_TIMEOUT, STREAM_MAX_CONNECTIONS, EMAIL_MAX_ATTEMPTS,
+                    EMAIL_RETRY_DELAY, EMAIL_CLAIM_TIMEOUT)
+
+
+def _new_connection():
+    """ Opens a new connection to the FoodShare database """
+    return mysql.connector.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_DB_USERNAME,
+        password=MYSQL_DB_PASSWORD,
+        database=MYSQL_DATABASE,
+        autocommit=True  # Single statements need no COMMIT, transactions are started explicitly where needed
+    )
+
+
+def run_migrations() -> list[str]:
+    """ Creates the database if needed and applies every migration in the migrations folder that has not been applied yet.
+
+    Migrations are files named "<version>_<description>.sql" and are applied in order of their version. Migrations
+    which cannot be written in SQL alone (e.g. converting data) are .py files instead, defining an upgrade(cur)
+    function which is called with a cursor on the database. The versions that have been applied are recorded in the
+    schema_version table, so each migration only ever runs once.
+
+    Returns:
+        The filenames of the migrations that were applied.
+    """
+    db = mysql.connector.connect(
+        host=MYSQL_HOST,
+        user=MYSQL_DB_USERNAME,
+        password=MYSQL_DB_PASSWORD
+    )
+    cur = db.cursor()
+    cur.execute(f"CREATE DATABASE IF NOT EXISTS {MYSQL_DATABASE}")
+    cur.execute(f"USE {MYSQL_DATABASE}")
+    # Only one process may migrate at a time, e.g. when several workers start up together
+    cur.execute("SELECT GET_LOCK('foodshare_migrations', 60)")
+    if cur.fetchone()[0] != 1:
+        db.close()
+        raise TimeoutError("Timed out waiting for another process to finish migrating the database.")
+
+    applied = []
+    try:
+        cur.execute("CREATE TABLE IF NOT EXISTS `schema_version` ("
+                    "`version` int(11) UNSIGNED NOT NULL PRIMARY KEY, "
+                    "`name` varchar(100) NOT NULL, "
+                    "`appliedat` bigint(20) NOT NULL)")
+        cur.execute("SELECT version FROM schema_version")
+        done = {row[0] for row in cur.fetchall()}
+
+        folder = os.path.join(os.getcwd(), MIGRATIONS_FOLDER)
+        migrations = sorted((int(filename.split("_")[0]), filename) for filename in os.listdir(folder)
+                            if filename.endswith((".sql", ".py")))
+        for version, filename in migrations:
+            if version in done:
+                continue
+            path = os.path.join(folder, filename)
+            if filename.endswith(".py"):
+                spec = importlib.util.spec_from_file_location(f"migration_{version}", path)
+                migration = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(migration)
+                migration.upgrade(cur)
+            else:
+                with open(path, "r") as f:
+                    for result in cur.execute(f.read(), multi=True):
+                        if result.with_rows:
+                            result.fetchall()
+            cur.execute("INSERT INTO schema_version (version, name, appliedat) VALUES (%s, %s, %s)",
+                        (version, filename, int(time.time())))
+            db.commit()
+            applied.append(filename)
+    finally:
+        cur.execute("SELECT RELEASE_LOCK('foodshare_migrations')")
+        cur.fetchall()
+        db.close()
+    return applied
+
+
+class ConnectionPool:
+    """ A thread-safe pool of MySQL connections shared by every *DB object in the process """
+    def __init__(self, size: int, timeout: float, connect=_new_connection):
+        self.size = size
+        self.timeout = timeout
+        self._connect = connect
+        # (connection, time it was handed back), most recently used first so that idle ones can time out server-side
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0  # Number of connections currently owned by the pool (idle or borrowed)
+        self._stats = {'borrowed': 0, 'waited': 0, 'timeouts': 0, 'created': 0, 'replaced': 0}
+
+    def get(self):
+        """ Borrows a healthy connection from the pool, opening a new one if the pool is not yet full.
+
+        Returns:
+            An open MySQL connection, which must be handed back using put().
+
+        Raises:
+            PoolError: If no connection becomes free within the checkout timeout.
+        """
+        try:
+            db, idle_since = self._idle.get_nowait()
+        except queue.Empty:
+            db, idle_since = None, time.monotonic()
+            with self._lock:
+                if self._opened < self.size:
+                    self._opened += 1
+                    self._stats['created'] += 1
+                    open_new = True
+                else:
+                    open_new = False
+            if open_new:
+                try:
+                    db = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            else:
+                with self._lock:
+                    self._stats['waited'] += 1
+                try:
+                    db, idle_since = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    raise PoolError(f"No MySQL connection became available within {self.timeout} seconds.")
+
+        # Health check, as the server may have closed a connection left idle for a while. It costs a round trip, so
+        # connections used moments ago are trusted without one.
+        if time.monotonic() - idle_since > MYSQL_POOL_PING_AFTER and not db.is_connected():
+            db = self._replace(db)
+        with self._lock:
+            self._stats['borrowed'] += 1
+        return db
+
+    def put(self, db) -> None:
+        """ Returns a borrowed connection to the pool.
+
+        Args:
+            db: The connection previously returned by get().
+        """
+        try:
+            if db.in_transaction:  # Never hand over an open transaction (or a stale read snapshot) to the next user
+                db.rollback()
+        except mysql.connector.Error:
+            db = self._replace(db)
+        self._idle.put((db, time.monotonic()))
+
+    def _replace(self, db):
+        """ Closes a broken connection and opens a fresh one in its place """
+        try:
+            db.close()
+        except mysql.connector.Error:
+            pass
+        try:
+            new_db = self._connect()
+        except Exception:
+            with self._lock:
+                self._opened -= 1  # Free up the slot so that the next borrower can try again
+            raise
+        with self._lock:
+            self._stats['replaced'] += 1
+        return new_db
+
+    def stats(self) -> dict:
+        """ Returns statistics about the usage of the pool.
+
+        Returns:
+            A dict containing the pool size, the number of open, idle and borrowed connections, and counters for
+            the number of checkouts, checkouts that had to wait, timed out checkouts, and created/replaced connections.
+        """
+        with self._lock:
+            idle = self._idle.qsize()
+            return {'size': self.size, 'open': self._opened, 'idle': idle, 'in_use': self._opened - idle,
+                    **self._stats}
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """ Returns the connection pool of the current process, creating it on first use (and again after a fork) """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():  # Connections must not be shared with a forked worker
+            _pool = ConnectionPool(MYSQL_POOL_SIZE, MYSQL_POOL_TIMEOUT)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+# Streamed results each need a connection of their own for as long as they are read, which is outside the pool
+_stream_slots = threading.BoundedSemaphore(STREAM_MAX_CONNECTIONS)
+
+_transaction = threading.local()  # The connection of the transaction() block each thread is in, if any
+
+
+@contextmanager
+def transaction():
+    """ Groups the changes made by any *DB objects within a with block into a single database transaction.
+
+    Every query in the block runs on one connection, and the changes are committed together when the block exits
+    successfully, or all rolled back if it raises. A transaction() block inside another one joins the outer transaction.
+    Note that an exception caught within the block does not roll anything back.
+    """
+    if getattr(_transaction, 'db', None) is not None:
+        yield
+        return
+
+    pool = get_pool()
+    db = pool.get()
+    _transaction.db = db
+    try:
+        db.start_transaction()
+        yield
+        if db.in_transaction:
+            db.commit()
+    except Exception:
+        try:
+            db.rollback()
+        except mysql.connector.Error:
+            pass  # The connection is broken, the pool will replace it
+        raise
+    finally:
+        _transaction.db = None
+        pool.put(db)
+
+
+_recorded = None  # While find_table_scans() runs, every statement run by a *DB object, with its first parameters
+
+
+class _RecordingCursor:
+    """ Wraps a cursor to note down each statement run through it, for find_table_scans() """
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, query, params=None, *args, **kwargs):
+        _recorded.setdefault(query, params)
+        return self._cur.execute(query, params, *args, **kwargs)
+
+    def executemany(self, query, seq_params, *args, **kwargs):
+        seq_params = list(seq_params)
+        if seq_params:
+            _recorded.setdefault(query, seq_params[0])
+        return self._cur.executemany(query, seq_params, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+def _new_cursor(db, **kwargs):
+    """ Opens a dict cursor on a connection, which records its statements while find_table_scans() runs """
+    cur = db.cursor(dictionary=True, **kwargs)
+    return cur if _recorded is None else _RecordingCursor(cur)
+
+
+class _Rollback(Exception):
+    """ Raised to discard the changes made in a transaction() block """
+
+
+def find_table_scans() -> list[str]:
+    """ Makes every lookup of the *DB classes, then EXPLAINs the statements they ran to find any that would scan a
+    whole table.
+
+    The lookups are made on throwaway records in a transaction which is rolled back, so the database is left as it was.
+    The statements are recorded as they are run, so the check always covers the SQL the *DB classes really send, with
+    parameters of the right types.
+
+    Returns:
+        A description of every table scan found, which is empty if all the statements use an index.
+    """
+    global _recorded
+    _recorded = {}
+    try:
+        with transaction():
+            _make_every_lookup()
+            raise _Rollback()
+    except _Rollback:
+        pass
+    finally:
+        statements, _recorded = _recorded, None
+
+    db = get_pool().get()
+    cur = db.cursor(dictionary=True)
+    scans = []
+    try:
+        for query, params in statements.items():
+            if not query.startswith(("SELECT", "UPDATE", "DELETE")) and " SELECT " not in query:
+                continue  # Nothing is looked up, e.g. INSERT ... VALUES
+            cur.execute("EXPLAIN " + query, params or [])
+            for step in cur.fetchall():
+                if step['type'] == "ALL":  # MySQL's access type for a full table scan
+                    scans.append(f"{query} scans the whole of {step['table']}")
+    finally:
+        cur.close()
+        get_pool().put(db)
+    return scans
+
+
+def _make_every_lookup() -> None:
+    """ Internal function which calls the methods of every *DB class that look records up, creating the records they
+    need along the way. The reads of whole tables (UserDB.get_all_users, RestaurantsDB.get_all_restaurants and
+    get_restaurants_by_distance, and OrdersDB.rebuild_rollups) are left out on purpose, as they are meant to scan.
+    """
+    udb, rdb, fdb, cdb, odb, reviewdb = UserDB(), RestaurantsDB(), FoodItemsDB(), CartDB(), OrdersDB(), ReviewsDB()
+    email = f"index-check-{uuid.uuid4().hex[:12]}@example.com"
+    userid = udb.add_user("Index", "Check", email, "1 Example Street", 0.0, 0.0, "Index-check-1")
+    udb.get_user(email=email)
+    udb.get_user(userid=userid)
+    udb.get_profile(userid)
+    udb.get_users([userid])
+    udb.check_credentials(email, "Index-check-1")
+    udb.edit_user(email, fname="Index")
+    reset_id = udb.generate_reset_id(email)
+    udb.lookup_reset_id(reset_id)
+    udb.delete_reset_id(reset_id)
+
+    restid = rdb.add_restaurant(userid, f"Index Check {userid}", "1 Example Street", 0.0, 0.0, "defaultcover.png")
+    rdb.get_restaurant(name=f"Index Check {userid}")
+    rdb.get_restaurant(restid=restid)
+    rdb.get_restaurant(userid=userid)
+    rdb.view_restaurant(restid=restid)
+    rdb.edit_restaurant(userid, open=1)
+
+    itemid = fdb.add_item(restid, "Index Check", "Index Check", 1.0, [], "defaultitem.png")
+    fdb.edit_item(itemid, inmenu=1)
+    fdb.get_item(itemid)
+    fdb.fetch_items(restid)
+    fdb.fetch_menu(restid)
+
+    cdb.increment_item(userid, itemid)
+    cdb.apply_changes(userid, {itemid: 2})
+    cdb.decrement_item(userid, itemid)
+    cdb.fetch_cart(userid)
+    cart = cdb.fetch_cart_detailed(userid, lock=True)
+    orderid = odb.create_order(userid, restid, cart['items'], cart['total'])
+    cdb.clear_cart(userid)
+
+    odb.mark_ready(orderid)
+    odb.fetch_order(orderid)
+    odb.fetch_order_items(orderid)
+    since = time.strftime("%Y-%m-%d")
+    odb.fetch_daily_sales(restid, since)
+    odb.fetch_item_sales(restid, since)
+    for before in (None, (int(time.time()), orderid)):  # The first page, and the pages after it
+        odb.fetch_user_orders(userid, before=before, limit=1)
+        odb.fetch_user_orders_detailed(userid, status=['Preparing', 'Ready'])
+        odb.fetch_user_orders_detailed(userid, status='Collected', before=before, limit=1)
+        odb.fetch_rest_orders(restid, before=before, limit=1)
+        odb.fetch_rest_orders_with_buyers(restid, status=['Preparing', 'Ready'])
+        odb.fetch_rest_orders_with_buyers(restid, status='Collected', before=before, limit=1)
+        odb.fetch_rest_orders_with_buyers(restid, since=time.time() - 86400)
+    list(odb.stream_rest_orders(restid))
+
+    reviewid = reviewdb.add_review(orderid, 5, "Index Check", "Index Check")
+    reviewdb.fetch_review(reviewid)
+    for before in (None, (int(time.time()), reviewid)):
+        reviewdb.fetch_rest_reviews(restid, before=before, limit=1)
+        reviewdb.fetch_user_reviews(userid, before=before, limit=1)
+    odb.mark_collected(orderid)
+    odb.cancel_order(orderid)
+
+    responsesdb = ContactFormResponsesDB()
+    responsesdb.add_response({'fname': "Index", 'lname': "Check", 'email': email, 'nature': "Other",
+                              'message': "Index Check", 'submittedat': time.time()})
+    for before in (None, (int(time.time()), 1)):
+        responsesdb.fetch_responses(before=before, limit=1)
+
+    outboxdb = EmailOutboxDB()
+    emailid = outboxdb.enqueue("Index Check", "Index Check", email, [email])
+    outboxdb.claim_batch(1)
+    outboxdb.mark_failed(emailid, "Index Check")
+    outboxdb.mark_sent(emailid)
+    outboxdb.fetch_dead()
+    outboxdb.purge_sent(0)
+
+    fdb.remove_item(itemid)
+    udb.delete_user(email)
 
 
 class MySQL:
     """ Superclass used to provide an interface with the MySQL Database through Inheritance """
     def __init__(self):
-        self.db = mysql.connector.connect(
-            host="localhost",
-            user=MYSQL_DB_USERNAME,
-            password=MYSQL_DB_PASSWORD
-        )
-        self.cur = self.db.cursor(dictionary=True)
-        with open("setup_db.sql", "r") as f:
-            self.cur.execute(f.read(), multi=True)  # Create database and tables during first run
-        self.cur.execute("USE foodshare")
+        self.pool = get_pool()  # Connections are borrowed per query, so creating a *DB object is cheap
+
+    @contextmanager
+    def _cursor(self, atomic: bool = False):
+        """ Borrows a connection from the pool for the duration of a with block and yields a cursor on it.
+
+        Each statement is committed as soon as it runs (autocommit), unless the block is atomic or within a
+        transaction() block.
+
+        Args:
+            atomic: Whether to run the block as one transaction, committed when it exits successfully and rolled back
+                otherwise. Only needed for blocks of several statements which must all apply or not at all. Within a
+                transaction() block, the transaction's connection is used instead and committed at its end.
+        """
+        if (db := getattr(_transaction, 'db', None)) is not None:
+            cur = _new_cursor(db)
+            try:
+                yield cur
+            finally:
+                cur.close()
+            return
+
+        db = self.pool.get()
+        cur = _new_cursor(db)
+        try:
+            if atomic:
+                db.start_transaction()
+            yield cur
+            if db.in_transaction:
+                db.commit()
+        except Exception:
+            try:
+                if db.in_transaction:
+                    db.rollback()
+            except mysql.connector.Error:
+                pass  # The connection is broken, the pool will replace it
+            raise
+        finally:
+            cur.close()
+            self.pool.put(db)
 
     def _insert(self, table_name: str, data: dict[str, Union[str, int, float, bool]]) -> int:
         """ Inserts a record into the specified table with the specified details
@@ -40,9 +456,9 @@ class MySQL:
         fields = ", ".join(data.keys())
         placeholders = ", ".join(["%s"] * len(data))
         # Values are passed separately below to prevent SQL injection as they are user inputs.
-        self.cur.execute(f"INSERT INTO {table_name} ({fields}) VALUES ({placeholders})", list(data.values()))
-        self.db.commit()
-        return self.cur.lastrowid
+        with self._cursor() as cur:
+            cur.execute(f"INSERT INTO {table_name} ({fields}) VALUES ({placeholders})", list(data.values()))
+            return cur.lastrowid
 
     def _select(self, table_name: str, fields: list[str], where: dict[str, Union[str, int, float, bool]] = None , select_one=False) -> Union[list[dict], dict]:
         """ Selects a record from the specified table with the specified details
@@ -60,16 +476,107 @@ class MySQL:
             Pass fields=["*"] to select all fields.
         """
         fields_query = ", ".join(fields)
-        if where:
-            where_query = " AND ".join([f"{key} = %s" for key in where.keys()])
+        with self._cursor() as cur:
+            if where:
+                where_query = " AND ".join([f"{key} = %s" for key in where.keys()])
+                # Values are passed separately below to prevent SQL injection as they are user inputs.
+                cur.execute(f"SELECT {fields_query} FROM {table_name} WHERE {where_query}", list(where.values()))
+            else:
+                cur.execute(f"SELECT {fields_query} FROM {table_name}")
+            if select_one:
+                result = cur.fetchone()
+                cur.fetchall()  # Discard any remaining rows so that the connection can be reused
+                return result
+            else:
+                return cur.fetchall()
+
+    def _query(self, query: str, params: list = None, select_one=False) -> Union[list[dict], dict]:
+        """ Runs a custom SELECT query, for lookups which cannot be expressed using _select (e.g. joins).
+
+        Args:
+            query: The SQL query, with a %s placeholder in place of each value.
+            params: The values for the placeholders in the query.
+            select_one: Whether to select one record or all records.
+
+        Returns:
+            The selected record(s).
+        """
+        with self._cursor() as cur:
             # Values are passed separately below to prevent SQL injection as they are user inputs.
-            self.cur.execute(f"SELECT {fields_query} FROM {table_name} WHERE {where_query}", list(where.values()))
-        else:
-            self.cur.execute(f"SELECT {fields_query} FROM {table_name}")
-        if select_one:
-            return self.cur.fetchone()
-        else:
-            return self.cur.fetchall()
+            cur.execute(query, params or [])
+            if select_one:
+                result = cur.fetchone()
+                cur.fetchall()  # Discard any remaining rows so that the connection can be reused
+                return result
+            else:
+                return cur.fetchall()
+
+    def _stream(self, query: str, params: list = None) -> Iterator[dict]:
+        """ Runs a custom SELECT query and yields its records one at a time, for results too large to hold in memory.
+
+        The query runs on a dedicated connection with an unbuffered cursor, so records are read from the server in
+        batches as they are consumed and a long download does not hold on to one of the pool's connections. At most
+        STREAM_MAX_CONNECTIONS of these connections are open at once in a process, on top of the pool's MYSQL_POOL_SIZE.
+        The connection is taken and the query run before this returns, so that a busy server is reported to the caller
+        before it starts sending its response.
+
+        Args:
+            query: The SQL query, with a %s placeholder in place of each value.
+            params: The values for the placeholders in the query.
+
+        Returns:
+            An iterator of each selected record.
+
+        Raises:
+            PoolError: If no other stream finishes within MYSQL_POOL_TIMEOUT seconds.
+        """
+        def records():
+            if not _stream_slots.acquire(timeout=MYSQL_POOL_TIMEOUT):
+                raise PoolError(f"No streaming MySQL connection became available within {MYSQL_POOL_TIMEOUT} seconds.")
+            try:
+                db = _new_connection()
+                try:
+                    cur = _new_cursor(db)  # Unbuffered, unlike fetchall() the rows are not all read up front
+                    # The server waits on the consumer between batches, e.g. a client downloading over a slow connection
+                    cur.execute("SET SESSION net_write_timeout = %s", [STREAM_WRITE_TIMEOUT])
+                    # Values are passed separately below to prevent SQL injection as they are user inputs.
+                    cur.execute(query, params or [])
+                    yield  # Paused here until the first record is read, with the connection already held
+                    while rows := cur.fetchmany(STREAM_BATCH_SIZE):
+                        yield from rows
+                finally:
+                    db.close()  # Also discards any unread rows if the consumer stopped early
+            finally:
+                _stream_slots.release()
+
+        stream = records()
+        next(stream)  # Started now, so that closing it (even before its first record) frees the connection and slot
+        return stream
+
+    @staticmethod
+    def _page(time_field: str, id_field: str, before: tuple[int, int] = None, limit: int = None,
+              has_where: bool = True) -> tuple[str, list]:
+        """ Returns the SQL which restricts a query to one page of results, newest first, using keyset pagination.
+
+        Args:
+            time_field: The time column the results are ordered by.
+            id_field: The unique ID column, which orders results with the same time.
+            before: The (time, id) of the last result of the previous page, or None for the first page.
+            limit: The maximum number of results on the page, or None for all of them.
+            has_where: Whether the query already ends in a WHERE condition, which the page's condition is added to.
+
+        Returns:
+            The SQL to append to the query, and the values for its placeholders.
+        """
+        sql, params = "", []
+        if before:
+            sql += f" {'AND' if has_where else 'WHERE'} ({time_field} < %s OR ({time_field} = %s AND {id_field} < %s))"
+            params += [before[0], before[0], before[1]]
+        sql += f" ORDER BY {time_field} DESC, {id_field} DESC"
+        if limit:
+            sql += " LIMIT %s"
+            params.append(limit)
+        return sql, params
 
     def _update(self, table_name: str, data: dict[str, Union[str, int, float, bool]], where: dict[str, Union[str, int, float, bool]]):
         """ Updates a record from the specified table with the specified details
@@ -82,24 +589,33 @@ class MySQL:
         data_query = ", ".join([f"{key} = %s" for key in data.keys()])
         where_query = " AND ".join([f"{key} = %s" for key in where.keys()])
         # Values are passed separately below to prevent SQL injection as they are user inputs.
-        self.cur.execute(f"UPDATE {table_name} SET {data_query} WHERE {where_query}", list(data.values()) + list(where.values()))
-        self.db.commit()
+        with self._cursor() as cur:
+            cur.execute(f"UPDATE {table_name} SET {data_query} WHERE {where_query}", list(data.values()) + list(where.values()))
 
-    def _delete(self, table_name: str, where: dict[str, Union[str, int, float, bool]]):
+    def _delete(self, table_name: str, where: dict[str, Union[str, int, float, bool]]) -> int:
         """ Deletes a record from the specified table with the specified details
 
         Args:
             table_name: The name of the table to delete from.
             where: The fields and values that are being selected as a dictionary.
+
+        Returns:
+            The number of records deleted.
         """
         where_query = " AND ".join([f"{key} = %s" for key in where.keys()])
         # Values are passed separately below to prevent SQL injection as they are user inputs.
-        self.cur.execute(f"DELETE FROM {table_name} WHERE {where_query}", list(where.values()))
-        self.db.commit()
+        with self._cursor() as cur:
+            cur.execute(f"DELETE FROM {table_name} WHERE {where_query}", list(where.values()))
+            return cur.rowcount
 
 
 class UserDB(MySQL):
     """ Used to perform actions related to users in the SQL Database """
+
+    # The non-secret details of users, shared by every request in the process
+    PROFILE_FIELDS = ["userid", "email", "fname", "lname", "address", "longitude", "latitude"]
+    profiles = LRUCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
     def __init__(self):
         super().__init__()  # Initialize database
 
@@ -123,7 +639,7 @@ class UserDB(MySQL):
 
         hashed_password, salt = hash_password(unhashed_password)
         user = {'fname': fname, 'lname': lname, 'email': email.lower(), 'address': address, 'longitude': round(longitude, 6),
-                'latitude': round(latitude, 6), 'hashed_password': hashed_password, 'salt': salt}
+                'latitude': round(latitude, 6), 'hashed_password': hashed_password, 'salt': salt, 'kdf': PASSWORD_KDF}
         userid = self._insert("users", user)
         return userid
 
@@ -135,10 +651,10 @@ class UserDB(MySQL):
             **kwargs: Arbitrary keyword arguments of details to change.
         """
         if kwargs.get("unhashed_password", None):
-            user = self.get_user(email)
-            hashed_password, salt = hash_password(kwargs.pop('unhashed_password'), user['salt'])
-            kwargs['hashed_password'] = hashed_password
+            hashed_password, salt = hash_password(kwargs.pop('unhashed_password'))  # New salt, with the current KDF
+            kwargs.update({'hashed_password': hashed_password, 'salt': salt, 'kdf': PASSWORD_KDF})
         self._update("users", kwargs, {"email": email.lower()})
+        self._invalidate_profile(email)
 
     def get_user(self, email: str = None, userid: int = None) -> Union[dict, None]:
         """ Fetch a user from the database given their email address.
@@ -169,6 +685,49 @@ class UserDB(MySQL):
         else:
             return None
 
+    def get_profile(self, userid: int) -> Union[dict, None]:
+        """ Fetches the non-secret details of a user (see PROFILE_FIELDS), from memory if they were fetched recently.
+
+        Args:
+            userid: The ID of the user.
+
+        Returns:
+            A dict consisting of the user's details if found, else None.
+        """
+        profile = self.profiles.get(userid)
+        if profile is LRUCache.MISSING:
+            profile = self._select("users", self.PROFILE_FIELDS, {"userid": userid}, select_one=True)
+            if profile:
+                profile['longitude'] = float(profile['longitude'])
+                profile['latitude'] = float(profile['latitude'])
+                self.profiles.set(userid, profile)
+        return dict(profile) if profile else None  # A copy, so that callers cannot change the cached profile
+
+    def _invalidate_profile(self, email: str) -> None:
+        """ Internal function to remove a user's cached profile after their details have changed """
+        user = self._select("users", ["userid"], {"email": email.lower()}, select_one=True)
+        if user:
+            self.profiles.invalidate(user['userid'])
+
+    def get_users(self, userids: list[int]) -> dict[int, dict]:
+        """ Fetches the public details (everything except the password hash, salt and reset id) of several users at once.
+
+        Args:
+            userids: The IDs of the users.
+
+        Returns:
+            A dict mapping each userid found to a dict consisting of the user's details.
+        """
+        if not userids:
+            return {}
+        placeholders = ", ".join(["%s"] * len(userids))
+        users = self._query("SELECT userid, email, fname, lname, address, longitude, latitude FROM users "
+                            f"WHERE userid IN ({placeholders})", list(userids))
+        for user in users:
+            user['longitude'] = float(user['longitude'])
+            user['latitude'] = float(user['latitude'])
+        return {user['userid']: user for user in users}
+
     def get_all_users(self) -> list[dict]:
         """ Fetch all the users from the database.
 
@@ -187,12 +746,16 @@ class UserDB(MySQL):
 
         Returns:
             True if the password is correct, False otherwise or if the account doesn't exist.
+
+        Raises:
+            HashingBusyError: If too many passwords are already waiting to be hashed.
         """
         user = self.get_user(email)
         if not user:
             return False
-        hashed_password, salt = hash_password(check_password, user['salt'])
-        if user['hashed_password'] == hashed_password:  # If password is correct
+        if verify_password(check_password, user['hashed_password'], user['salt'], user['kdf']):  # If password is correct
+            if needs_rehash(user['kdf']):  # Upgrade the hash to the current KDF now that we know the password
+                self.edit_user(email, unhashed_password=check_password)
             return user
 
     def delete_user(self, email: str) -> None:
@@ -201,6 +764,7 @@ class UserDB(MySQL):
         Args:
             email: The email address of the user.
         """
+        self._invalidate_profile(email)
         self._delete("users", {"email": email.lower()})
 
     def generate_reset_id(self, email: str) -> int:
@@ -243,9 +807,20 @@ class UserDB(MySQL):
 
 class RestaurantsDB(MySQL):
     """ Used to perform actions related to restaurants in the SQL Database """
+
+    # Snapshot of all restaurants and an index of their coordinates, shared by every request in the process and
+    # reloaded when the catalog version changes
+    _catalog = {'version': None, 'restaurants': [], 'index': DistanceIndex([])}
+    _catalog_lock = threading.Lock()
+
     def __init__(self):
         super().__init__()  # Initialize database
 
+    def _bump_catalog_version(self) -> None:
+        """ Internal function to signal to every process that restaurant details have changed """
+        with self._cursor() as cur:
+            cur.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+
     def add_restaurant(self, userid: int, name: str, address: str, longitude: float, latitude: float, coverpic: str) -> Union[int, bool]:
         """ Adds a restaurant to the database.
 
@@ -271,6 +846,7 @@ class RestaurantsDB(MySQL):
         restaurant = {'userid': userid, 'name': name, 'address': address, 'longitude': longitude,
                       'latitude': latitude, 'coverpic': coverpic}
         restid = self._insert("restaurants", restaurant)
+        self._bump_catalog_version()
         return restid
 
     def edit_restaurant(self, userid: int, **kwargs) -> None:
@@ -282,6 +858,7 @@ class RestaurantsDB(MySQL):
         """
 
         self._update("restaurants", kwargs, {"userid": userid})
+        self._bump_catalog_version()
 
     def get_restaurant(self, name: str = None, restid: int = None, userid: int = None) -> dict:
         """ Fetches a restaurant from the database given name, email or its unique id.
@@ -329,29 +906,68 @@ class RestaurantsDB(MySQL):
         """
         restaurant = self.get_restaurant(name=name, restid=restid, userid=userid)
         if restaurant:
-            restaurant['menu'] = FoodItemsDB().fetch_menu(restaurant['restid'])
+            restaurant['menu'] = FoodItemsDB().fetch_menu(restaurant['restid'], menuversion=restaurant['menuversion'])
             if restaurant['avgreview']: restaurant['avgreview'] = float(restaurant['avgreview'])
         return restaurant
 
-    def get_all_restaurants(self) -> list[dict]:
-        """ Fetches all restaurants from the database .
+    def _load_catalog(self) -> dict:
+        """ Internal function returning the process's snapshot of all restaurants, reloading it if any has changed """
+        version = self._select("catalog_version", ["version"], {"id": 1}, select_one=True)['version']
+        with self._catalog_lock:
+            if self._catalog['version'] == version:
+                return dict(self._catalog)
 
-        Returns:
-            A list of dicts consisting of the restaurant details.
-        """
         restaurants = self._select("restaurants", ["*"])
         for restaurant in restaurants:
             restaurant['longitude'] = float(restaurant['longitude'])
             restaurant['latitude'] = float(restaurant['latitude'])
             if restaurant['avgreview']: restaurant['avgreview'] = float(restaurant['avgreview'])
-        return restaurants
+        index = DistanceIndex([(restaurant['longitude'], restaurant['latitude']) for restaurant in restaurants])
+        catalog = {'version': version, 'restaurants': restaurants, 'index': index}
+        with self._catalog_lock:
+            # Tagged with the version read before loading, so that a change made meanwhile causes another reload
+            self._catalog.update(catalog)
+        return catalog
+
+    def get_all_restaurants(self) -> list[dict]:
+        """ Fetches all restaurants from the database, reusing the process's snapshot if no restaurant has changed since.
+
+        Returns:
+            A list of dicts consisting of the restaurant details.
+        """
+        # Copies, so that callers (e.g. adding distances) cannot change the snapshot
+        return [dict(restaurant) for restaurant in self._load_catalog()['restaurants']]
+
+    def get_restaurants_by_distance(self, coord: tuple[float, float]) -> list[dict]:
+        """ Fetches all restaurants sorted by their straight-line distance from a coordinate, using the snapshot's index.
+
+        Args:
+            coord: The (longitude, latitude) to measure from.
+
+        Returns:
+            A list of dicts consisting of the restaurant details, nearest first, with the distance in metres under the
+            'distance' key.
+        """
+        catalog = self._load_catalog()
+        return [dict(catalog['restaurants'][position], distance=int(distance))
+                for position, distance in catalog['index'].nearest(coord)]
 
 
 class FoodItemsDB(MySQL):
     """ Used to perform actions related to food items in the SQL Database """
+
+    # Decoded menus by restid, shared by every request in the process and tagged with the restaurant's menuversion
+    menus = LRUCache(MENU_CACHE_SIZE)
+
     def __init__(self):
         super().__init__()  # Initialize database
 
+    def _menu_changed(self, restid: int) -> None:
+        """ Internal function to drop the cached menu of a restaurant, in this process and (via menuversion) in others """
+        with self._cursor() as cur:
+            cur.execute("UPDATE restaurants SET menuversion = menuversion + 1 WHERE restid = %s", (restid,))
+        self.menus.invalidate(restid)
+
     def add_item(self, restid: int, name: str, description: str, price: float,
                  restrictions: dict, picture: str = None) -> int:
         """ Adds a restaurant to the database.
@@ -384,6 +1000,7 @@ class FoodItemsDB(MySQL):
         item = {'restid': restid, 'name': name, 'description': description, 'price': price,
                 'restrictions': ", ".join(restrictions), 'picture': picture}
         itemid = self._insert("fooditems", item)
+        self._menu_changed(restid)
         return itemid
 
     def edit_item(self, itemid: int, **kwargs) -> None:
@@ -396,6 +1013,8 @@ class FoodItemsDB(MySQL):
         if 'restrictions' in kwargs.keys():
             kwargs['restrictions'] = ", ".join(kwargs['restrictions'])
         self._update("fooditems", kwargs, {"itemid": itemid})
+        if item := self._select("fooditems", ["restid"], {"itemid": itemid}, select_one=True):
+            self._menu_changed(item['restid'])
 
     def remove_item(self, itemid: int):
         """ Removes a food item from the database.
@@ -403,7 +1022,12 @@ class FoodItemsDB(MySQL):
         Args:
             itemid: The unique ID of the food item.
         """
-        self._delete("fooditems", {"itemid": itemid})
+        item = self._select("fooditems", ["restid"], {"itemid": itemid}, select_one=True)
+        with self._cursor(atomic=True) as cur:  # Also taken out of every cart, where it could no longer be shown or ordered
+            cur.execute("DELETE FROM cart WHERE itemid = %s", [itemid])
+            cur.execute("DELETE FROM fooditems WHERE itemid = %s", [itemid])
+        if item:
+            self._menu_changed(item['restid'])
 
     def get_item(self, itemid: int) -> dict:
         """ Fetches a food item from the database given its id.
@@ -435,19 +1059,28 @@ class FoodItemsDB(MySQL):
             item['restrictions'] = item['restrictions'].split(", ")
         return items
 
-    def fetch_menu(self, restid: int) -> list[dict]:
+    def fetch_menu(self, restid: int, menuversion: int = None) -> list[dict]:
         """ Fetches all food items added by a restaurant and in the menu from the database.
 
         Args:
             restid: The unique ID of the restaurant being queried.
+            menuversion: The restaurant's current menuversion, which allows the menu to be served from memory if it
+                has not changed since it was cached (optional).
 
         Returns:
             A list of dicts consisting of each food item.
         """
+        if menuversion is not None:
+            cached = self.menus.get(restid)
+            if cached is not LRUCache.MISSING and cached[0] == menuversion:
+                return [dict(item, restrictions=list(item['restrictions'])) for item in cached[1]]  # Copies
+
         menu = self._select("fooditems", ["*"], {"restid": restid, "inmenu": True})
         for item in menu:
             item['price'] = float(item['price'])
             item['restrictions'] = item['restrictions'].split(", ")
+        if menuversion is not None:
+            self.menus.set(restid, (menuversion, [dict(item, restrictions=list(item['restrictions'])) for item in menu]))
         return menu
 
 
@@ -456,6 +1089,36 @@ class CartDB(MySQL):
     def __init__(self):
         super().__init__()  # Initialize database
 
+    @staticmethod
+    def _add(cur, userid: int, itemid: int, quantity: int):
+        """ Internal function to add some of an item to a cart in a single statement using the given cursor.
+
+        Raises:
+            ValueError: If items from multiple restaurants are being added to cart, or the item does not exist.
+        """
+        # The item is only added if the cart holds no items from another restaurant
+        cur.execute("INSERT INTO cart (userid, restid, itemid, quantity) "
+                    "SELECT %s, f.restid, f.itemid, %s FROM fooditems f "
+                    "WHERE f.itemid = %s "
+                    "AND NOT EXISTS (SELECT 1 FROM cart c WHERE c.userid = %s AND c.restid != f.restid) "
+                    "ON DUPLICATE KEY UPDATE quantity = quantity + VALUES(quantity)", [userid, quantity, itemid, userid])
+        if cur.rowcount == 0:  # 1 if the item was added, 2 if it was already in the cart
+            raise ValueError("Cannot add items from multiple restaurants to the cart.")
+
+    @staticmethod
+    def _remove(cur, userid: int, itemid: int, quantity: int):
+        """ Internal function to remove some of an item from a cart using the given cursor, deleting it if none are left.
+
+        Raises:
+            ValueError: If the item is not in the cart.
+        """
+        cur.execute("UPDATE cart SET quantity = quantity - %s WHERE userid = %s AND itemid = %s AND quantity > %s",
+                    [quantity, userid, itemid, quantity])
+        if cur.rowcount == 0:  # Decrement to zero (or below) = Delete
+            cur.execute("DELETE FROM cart WHERE userid = %s AND itemid = %s", [userid, itemid])
+            if cur.rowcount == 0:
+                raise ValueError("Item not in cart.")
+
     def increment_item(self, userid: int, itemid: int):
         """ Adds/increments an item to the cart of the user.
 
@@ -463,23 +1126,11 @@ class CartDB(MySQL):
             userid: Id of the user whom the item is being added to.
             itemid: Id of the item being added.
 
-        Returns:
-            True if the item was added to the cart, False if the item mismatches with the preexisting restaurant.
-
         Raises:
-            ValueError: If items from multiple restaurants are being added to cart.
+            ValueError: If items from multiple restaurants are being added to cart, or the item does not exist.
         """
-        cart = self.fetch_cart(userid)
-        if cart:
-            if cart[0]['restid'] != FoodItemsDB().get_item(itemid)['restid']:
-                raise ValueError("Cannot add items from multiple restaurants to the cart.")
-
-        cart = {item['itemid']: item['quantity'] for item in cart}
-
-        if itemid in cart.keys():  # If item is already in cart
-            self._update("cart", {"quantity": cart[itemid] + 1}, {"userid": userid, "itemid": itemid})
-        else:
-            self._insert("cart", {"userid": userid, "itemid": itemid, "quantity": 1, "restid": FoodItemsDB().get_item(itemid)['restid']})
+        with self._cursor() as cur:
+            self._add(cur, userid, itemid, 1)
 
     def decrement_item(self, userid: int, itemid: int) -> None:
         """ Removes/decrements an item from the cart of the user.
@@ -491,16 +1142,32 @@ class CartDB(MySQL):
         Raises:
             ValueError: If the item is not in the cart.
         """
-        cart = self.fetch_cart(userid)
-        cart = {item['itemid']: item['quantity'] for item in cart}
+        with self._cursor(atomic=True) as cur:
+            self._remove(cur, userid, itemid, 1)
 
-        if itemid in cart.keys():
-            if cart[itemid] == 1:  # Decrement to zero = Delete
-                self._delete("cart", {"userid": userid, "itemid": itemid})
-            else:
-                self._update("cart", {"quantity": cart[itemid] - 1}, {"userid": userid, "itemid": itemid})
-        else:
-            raise ValueError("Item not in cart.")
+    def apply_changes(self, userid: int, changes: dict[int, int]) -> dict[int, int]:
+        """ Applies a batch of quantity changes to the cart of the user in one transaction.
+
+        Args:
+            userid: Id of the user whose cart is being changed.
+            changes: The change in quantity of each item, by itemid (negative to remove some of the item).
+
+        Returns:
+            The quantity of each item in the cart after the changes, by itemid.
+
+        Raises:
+            ValueError: If any of the changes is invalid (see increment_item and decrement_item), in which case none
+                of the changes are applied.
+        """
+        with self._cursor(atomic=True) as cur:
+            # Removals first, so that emptying the cart and adding items from another restaurant works in one batch
+            for itemid, delta in sorted(changes.items(), key=lambda change: change[1]):
+                if delta < 0:
+                    self._remove(cur, userid, itemid, -delta)
+                elif delta > 0:
+                    self._add(cur, userid, itemid, delta)
+            cur.execute("SELECT itemid, quantity FROM cart WHERE userid = %s", [userid])
+            return {row['itemid']: row['quantity'] for row in cur.fetchall()}
 
     def fetch_cart(self, userid: int) -> list[dict]:
         """ Fetches all cart items added by a user from the database.
@@ -514,13 +1181,53 @@ class CartDB(MySQL):
         items = self._select("cart", ["restid", "itemid", "quantity"], {"userid": userid})
         return items
 
-    def clear_cart(self, userid: int):
+    def fetch_cart_detailed(self, userid: int, lock: bool = False) -> Union[dict, None]:
+        """ Fetches the cart of a user along with the details of each item and of the restaurant in a single query.
+
+        Args:
+            userid: The unique ID of the user being queried.
+            lock: Whether to lock the user's cart against changes until the end of the enclosing transaction() block,
+                e.g. while an order is placed from it.
+
+        Returns:
+            None if the cart is empty, else a dict consisting of:
+                restaurant: The restid, userid, name, address and open status of the restaurant.
+                items: A list of dicts consisting of each food item's details, its quantity and its total price.
+                total: The total price of the cart.
+        """
+        if lock:
+            # Only the cart rows are locked, not the food item and restaurant rows shared with every other buyer
+            self._query("SELECT itemid FROM cart WHERE userid = %s FOR UPDATE", [userid])
+        rows = self._query("SELECT c.quantity, f.*, r.userid AS rest_userid, r.name AS rest_name, "
+                           "r.address AS rest_address, r.open AS rest_open "
+                           "FROM cart c "
+                           "JOIN fooditems f ON f.itemid = c.itemid "
+                           "JOIN restaurants r ON r.restid = c.restid "
+                           "WHERE c.userid = %s", [userid])
+        if not rows:
+            return None
+
+        restaurant = {'restid': rows[0]['restid'], 'userid': rows[0]['rest_userid'], 'name': rows[0]['rest_name'],
+                      'address': rows[0]['rest_address'], 'open': rows[0]['rest_open']}
+        items = []
+        for row in rows:
+            item = {key: value for key, value in row.items() if not key.startswith("rest_")}
+            item['price'] = float(item['price'])
+            item['restrictions'] = item['restrictions'].split(", ")
+            item['total'] = round(item['quantity'] * item['price'], 2)
+            items.append(item)
+        return {'restaurant': restaurant, 'items': items, 'total': sum(item['total'] for item in items)}
+
+    def clear_cart(self, userid: int) -> int:
         """ Clears the cart of the user.
 
         Args:
             userid: The unique ID of the user being queried.
+
+        Returns:
+            The number of different items that were in the cart.
         """
-        self._delete("cart", {"userid": userid})
+        return self._delete("cart", {"userid": userid})
 
 
 class OrdersDB(MySQL):
@@ -534,14 +1241,32 @@ class OrdersDB(MySQL):
         Args:
             userid: The unique ID of the user placing the order.
             restid: The unique ID of the restaurant the order is being placed at.
-            items: A list of dicts containing the itemid, name, quantity, and price of each item in the order.
+            items: A list of dicts containing the itemid, name, price, quantity and total price of each item in the order.
             amount: The total price of the order.
 
         Returns:
             The unique ID of the order.
         """
-        order = {'userid': userid, 'restid': restid, 'items': json.dumps(items), 'amount': amount, 'ordertime': time.time()}
-        orderid = self._insert("orders", order)
+        ordertime = time.time()
+        # The order, its items and the sales rollups are saved together, or not at all
+        with self._cursor(atomic=True) as cur:
+            cur.execute("INSERT INTO orders (userid, restid, amount, ordertime) VALUES (%s, %s, %s, %s)",
+                        [userid, restid, amount, ordertime])
+            orderid = cur.lastrowid
+            cur.executemany("INSERT INTO order_items (orderid, itemid, name, price, quantity, total) "
+                            "VALUES (%s, %s, %s, %s, %s, %s)",
+                            [(orderid, item['itemid'], item['name'], item['price'], item['quantity'], item['total'])
+                             for item in items])
+            cur.execute("INSERT INTO sales_daily (restid, day, orders, revenue) "
+                        "VALUES (%s, DATE(FROM_UNIXTIME(%s)), 1, %s) "
+                        "ON DUPLICATE KEY UPDATE orders = orders + 1, revenue = revenue + VALUES(revenue)",
+                        [restid, round(ordertime), amount])
+            cur.executemany("INSERT INTO item_sales_daily (restid, day, itemid, name, units, revenue) "
+                            "VALUES (%s, DATE(FROM_UNIXTIME(%s)), %s, %s, %s, %s) "
+                            "ON DUPLICATE KEY UPDATE name = VALUES(name), units = units + VALUES(units), "
+                            "revenue = revenue + VALUES(revenue)",
+                            [(restid, round(ordertime), item['itemid'], item['name'], item['quantity'], item['total'])
+                             for item in items])
         return orderid
 
     def mark_ready(self, orderid: int):
@@ -553,49 +1278,226 @@ class OrdersDB(MySQL):
         self._update("orders", {"orderstatus": "Ready"}, {"orderid": orderid})
 
     def mark_collected(self, orderid: int):
-        """ Marks an order as collected.
+        """ Marks an order as collected, and counts it as collected in the sales rollups.
 
         Args:
             orderid: The unique ID of the order.
         """
-        self._update("orders", {"orderstatus": "Collected"}, {"orderid": orderid})
+        with self._cursor(atomic=True) as cur:
+            cur.execute("SELECT restid, ordertime, orderstatus FROM orders WHERE orderid = %s FOR UPDATE", [orderid])
+            order = cur.fetchone()
+            if not order or order['orderstatus'] == 'Collected':  # Only count each order once
+                return
+            cur.execute("UPDATE orders SET orderstatus = 'Collected' WHERE orderid = %s", [orderid])
+            cur.execute("UPDATE sales_daily SET collected = collected + 1 "
+                        "WHERE restid = %s AND day = DATE(FROM_UNIXTIME(%s))", [order['restid'], order['ordertime']])
 
     def cancel_order(self, orderid: int):
-        """ Cancels an order.
+        """ Cancels an order, removing it from the sales rollups and counting it as a cancellation instead.
 
         Args:
             orderid: The unique ID of the order being cancelled.
         """
-        self._delete("orders", {"orderid": orderid})
+        with self._cursor(atomic=True) as cur:
+            # The order is read before it is deleted, as the rollups of the day it was placed on are updated
+            cur.execute("SELECT restid, ordertime, orderstatus, amount FROM orders WHERE orderid = %s FOR UPDATE",
+                        [orderid])
+            order = cur.fetchone()
+            if not order:  # Already cancelled
+                return
+            cur.execute("UPDATE sales_daily SET orders = orders - 1, revenue = revenue - %s, collected = collected - %s, "
+                        "cancellations = cancellations + 1 "
+                        "WHERE restid = %s AND day = DATE(FROM_UNIXTIME(%s))",
+                        [order['amount'], int(order['orderstatus'] == 'Collected'), order['restid'], order['ordertime']])
+            cur.execute("UPDATE item_sales_daily s JOIN order_items i ON i.itemid = s.itemid "
+                        "SET s.units = s.units - i.quantity, s.revenue = s.revenue - i.total "
+                        "WHERE i.orderid = %s AND s.restid = %s AND s.day = DATE(FROM_UNIXTIME(%s))",
+                        [orderid, order['restid'], order['ordertime']])
+            cur.execute("DELETE FROM order_items WHERE orderid = %s", [orderid])
+            cur.execute("DELETE FROM orders WHERE orderid = %s", [orderid])
+
+    def fetch_daily_sales(self, restid: int, since: str) -> list[dict]:
+        """ Fetches the daily sales rollups of a restaurant.
+
+        Args:
+            restid: The unique ID of the restaurant being queried.
+            since: The first day to fetch, as a YYYY-MM-DD date.
+
+        Returns:
+            A list of dicts consisting of the day, number of orders, revenue, number of collected orders and number of
+            cancellations for each day with any orders, oldest first.
+        """
+        sales = self._query("SELECT day, orders, revenue, collected, cancellations FROM sales_daily "
+                            "WHERE restid = %s AND day >= %s ORDER BY day", [restid, since])
+        return sales
+
+    def fetch_item_sales(self, restid: int, since: str) -> list[dict]:
+        """ Fetches the units sold and revenue of each food item of a restaurant, from its daily item sales rollups.
+
+        Args:
+            restid: The unique ID of the restaurant being queried.
+            since: The first day to include, as a YYYY-MM-DD date.
+
+        Returns:
+            A list of dicts consisting of the itemid, name, units sold and revenue of each item, best selling first.
+        """
+        items = self._query("SELECT itemid, MAX(name) AS name, SUM(units) AS units, SUM(revenue) AS revenue "
+                            "FROM item_sales_daily WHERE restid = %s AND day >= %s "
+                            "GROUP BY itemid HAVING SUM(units) > 0 ORDER BY units DESC, revenue DESC",
+                            [restid, since])
+        return items
 
-    def fetch_user_orders(self, userid: int) -> list[dict]:
-        """ Fetches all orders placed by a user from the database.
+    def rebuild_rollups(self):
+        """ Recomputes the sales rollups of every restaurant from the orders table, e.g. after fixing data by hand.
+
+        Cancelled orders are deleted from the orders table, so the existing cancellation counts are kept as they are.
+        """
+        with self._cursor(atomic=True) as cur:
+            cur.execute("UPDATE sales_daily SET orders = 0, revenue = 0, collected = 0")
+            cur.execute("INSERT INTO sales_daily (restid, day, orders, revenue, collected) "
+                        "SELECT restid, DATE(FROM_UNIXTIME(ordertime)), COUNT(*), SUM(amount), "
+                        "SUM(orderstatus = 'Collected') "
+                        "FROM orders GROUP BY restid, DATE(FROM_UNIXTIME(ordertime)) "
+                        "ON DUPLICATE KEY UPDATE orders = VALUES(orders), revenue = VALUES(revenue), "
+                        "collected = VALUES(collected)")
+            cur.execute("DELETE FROM sales_daily WHERE orders = 0 AND cancellations = 0")
+            cur.execute("DELETE FROM item_sales_daily")
+            cur.execute("INSERT INTO item_sales_daily (restid, day, itemid, name, units, revenue) "
+                        "SELECT o.restid, DATE(FROM_UNIXTIME(o.ordertime)), i.itemid, MAX(i.name), SUM(i.quantity), "
+                        "SUM(i.total) "
+                        "FROM orders o JOIN order_items i ON i.orderid = o.orderid "
+                        "GROUP BY o.restid, DATE(FROM_UNIXTIME(o.ordertime)), i.itemid")
+
+    def fetch_user_orders(self, userid: int, before: tuple[int, int] = None, limit: int = None) -> list[dict]:
+        """ Fetches the orders placed by a user from the database, a page at a time.
 
         Args:
             userid: The unique ID of the user being queried.
+            before: The (ordertime, orderid) of the last order of the previous page, or None for the first page.
+            limit: The maximum number of orders to fetch, or None for all of them.
 
         Returns:
-            A list of dicts consisting of each order.
+            A list of dicts consisting of each order, newest first.
         """
-        orders = self._select("orders", ["*"], {"userid": userid})
+        page, params = self._page("ordertime", "orderid", before, limit)
+        orders = self._query("SELECT * FROM orders WHERE userid = %s" + page, [userid] + params)
+        return orders
+
+    def fetch_user_orders_detailed(self, userid: int, status: Union[str, list[str]] = None,
+                                   before: tuple[int, int] = None, limit: int = None) -> list[dict]:
+        """ Fetches the orders placed by a user along with each restaurant and the user's review in a single query.
+
+        Args:
+            userid: The unique ID of the user being queried.
+            status: Only fetch orders with this order status, or with any of these statuses if a list (optional).
+            before: The (ordertime, orderid) of the last order of the previous page, or None for the first page.
+            limit: The maximum number of orders to fetch, or None for all of them.
+
+        Returns:
+            A list of dicts consisting of each order, newest first, with the restid, name and address of the
+            restaurant under the 'restaurant' key, and the stars the user gave the order under the 'review' key
+            (None if the order has not been reviewed yet).
+        """
+        query = ("SELECT o.*, r.name AS rest_name, r.address AS rest_address, v.stars AS review "
+                 "FROM orders o "
+                 "LEFT JOIN restaurants r ON r.restid = o.restid "
+                 "LEFT JOIN reviews v ON v.orderid = o.orderid "
+                 "WHERE o.userid = %s")
+        params = [userid]
+        if status:
+            statuses = [status] if isinstance(status, str) else status
+            query += f" AND o.orderstatus IN ({', '.join(['%s'] * len(statuses))})"
+            params += statuses
+        page, page_params = self._page("o.ordertime", "o.orderid", before, limit)
+        orders = self._query(query + page, params + page_params)
         for order in orders:
-            order['items'] = json.loads(order['items'])
+            order['restaurant'] = {'restid': order['restid'], 'name': order.pop('rest_name'),
+                                   'address': order.pop('rest_address')}
         return orders
 
-    def fetch_rest_orders(self, restid: int) -> list[dict]:
-        """ Fetches all orders placed at a restaurant from the database.
+    def fetch_rest_orders(self, restid: int, before: tuple[int, int] = None, limit: int = None) -> list[dict]:
+        """ Fetches the orders placed at a restaurant from the database, a page at a time.
 
         Args:
             restid: The unique ID of the restaurant being queried.
+            before: The (ordertime, orderid) of the last order of the previous page, or None for the first page.
+            limit: The maximum number of orders to fetch, or None for all of them.
 
         Returns:
-            A list of dicts consisting of each order.
+            A list of dicts consisting of each order, newest first.
         """
-        orders = self._select("orders", ["*"], {"restid": restid})
+        page, params = self._page("ordertime", "orderid", before, limit)
+        orders = self._query("SELECT * FROM orders WHERE restid = %s" + page, [restid] + params)
+        return orders
+
+    def fetch_rest_orders_with_buyers(self, restid: int, status: Union[str, list[str]] = None, since: float = None,
+                                      before: tuple[int, int] = None, limit: int = None) -> list[dict]:
+        """ Fetches the orders placed at a restaurant along with the details of each buyer in a single query.
+
+        Args:
+            restid: The unique ID of the restaurant being queried.
+            status: Only fetch orders with this order status, or with any of these statuses if a list (optional).
+            since: Only fetch orders placed at or after this unix timestamp (optional).
+            before: The (ordertime, orderid) of the last order of the previous page, or None for the first page.
+            limit: The maximum number of orders to fetch, or None for all of them.
+
+        Returns:
+            A list of dicts consisting of each order, newest first, with the buyer's userid, fname, lname and email
+            under the 'buyer' key.
+        """
+        query = ("SELECT o.*, u.fname AS buyer_fname, u.lname AS buyer_lname, u.email AS buyer_email "
+                 "FROM orders o JOIN users u ON u.userid = o.userid "
+                 "WHERE o.restid = %s")
+        params = [restid]
+        if status:
+            statuses = [status] if isinstance(status, str) else status
+            query += f" AND o.orderstatus IN ({', '.join(['%s'] * len(statuses))})"
+            params += statuses
+        if since is not None:
+            query += " AND o.ordertime >= %s"
+            params.append(since)
+        page, page_params = self._page("o.ordertime", "o.orderid", before, limit)
+
+        orders = self._query(query + page, params + page_params)
         for order in orders:
-            order['items'] = json.loads(order['items'])
+            order['buyer'] = {'userid': order['userid'], 'fname': order.pop('buyer_fname'),
+                              'lname': order.pop('buyer_lname'), 'email': order.pop('buyer_email')}
         return orders
 
+    def stream_rest_orders(self, restid: int) -> Iterator[dict]:
+        """ Streams every order placed at a restaurant along with the name and email of each buyer, oldest first.
+
+        Args:
+            restid: The unique ID of the restaurant being queried.
+
+        Returns:
+            An iterator of a dict for each order, with the itemid, name, price, quantity and total price of each of its
+            items under the 'items' key.
+
+        Raises:
+            PoolError: If too many other streams are running (see _stream).
+        """
+        # One row per item, the rows of each order arrive together and are grouped back into a single order
+        lines = self._stream("SELECT o.orderid, o.ordertime, o.orderstatus, o.amount, "
+                             "u.fname AS buyer_fname, u.lname AS buyer_lname, u.email AS buyer_email, "
+                             "i.itemid, i.name, i.price, i.quantity, i.total "
+                             "FROM orders o "
+                             "JOIN users u ON u.userid = o.userid "
+                             "JOIN order_items i ON i.orderid = o.orderid "
+                             "WHERE o.restid = %s "
+                             "ORDER BY o.ordertime, o.orderid", [restid])
+
+        def orders():
+            for _, rows in itertools.groupby(lines, key=lambda line: line['orderid']):
+                items = []
+                for row in rows:
+                    items.append({'itemid': row.pop('itemid'), 'name': row.pop('name'),
+                                  'price': float(row.pop('price')), 'quantity': row.pop('quantity'),
+                                  'total': float(row.pop('total'))})
+                yield row | {'items': items}
+
+        return orders()
+
     def fetch_order(self, orderid: int) -> dict:
         """ Fetches an order from the database given its id.
 
@@ -606,9 +1508,20 @@ class OrdersDB(MySQL):
             A dict consisting of the order details
         """
         order = self._select("orders", ["*"], {"orderid": orderid}, select_one=True)
-        order['items'] = json.loads(order['items'])
         return order
 
+    def fetch_order_items(self, orderid: int) -> list[dict]:
+        """ Fetches the items of an order, for the views which show them (e.g. invoices).
+
+        Args:
+            orderid: The unique ID of the order.
+
+        Returns:
+            A list of dicts consisting of the itemid, name, price, quantity and total price of each item in the order.
+        """
+        items = self._select("order_items", ["itemid", "name", "price", "quantity", "total"], {"orderid": orderid})
+        return items
+
 
 class ContactFormResponsesDB(MySQL):
     """ Used to store contact form responses in the SQL Database """
@@ -630,13 +1543,18 @@ class ContactFormResponsesDB(MySQL):
         """
         self._insert("contactformresponses", response)
 
-    def fetch_responses(self) -> list[dict]:
-        """ Fetches all responses from the database.
+    def fetch_responses(self, before: tuple[int, int] = None, limit: int = None) -> list[dict]:
+        """ Fetches the responses from the database, a page at a time.
+
+        Args:
+            before: The (submittedat, responseid) of the last response of the previous page, or None for the first page.
+            limit: The maximum number of responses to fetch, or None for all of them.
 
         Returns:
-            A list of dicts consisting of each response.
+            A list of dicts consisting of each response, newest first.
         """
-        responses = self._select("contactformresponses", ["*"])
+        page, params = self._page("submittedat", "responseid", before, limit, has_where=False)
+        responses = self._query("SELECT * FROM contactformresponses" + page, params)
         return responses
 
 
@@ -646,56 +1564,73 @@ class ReviewsDB(MySQL):
         super().__init__()  # Initialize database
 
     def add_review(self, orderid: int, stars: int, title: str, description: str) -> int:
-        """ Adds a review to the database and updates the restaurants table with the new rating.
+        """ Adds a review to the database and updates the restaurant's rating and star histogram in the same transaction.
 
         Args:
             orderid: The unique ID of the order the review is for.
-            stars: The number of stars given in the review.
+            stars: The number of stars given in the review, from 1 to 5.
             title: The title of the review.
             description: The description of the review.
 
         Returns:
             The unique ID of the review.
+
+        Raises:
+            ValueError: If the number of stars is not from 1 to 5, the order does not exist or it has been reviewed.
         """
-        # Insert into reviews table
-        order = OrdersDB().fetch_order(orderid)
-        review = {'orderid': orderid, 'stars': stars, 'title': title, 'description': description, 'submittedat': time.time(),
-                  'userid': order['userid'], 'restid': order['restid']}
-        reviewid = self._insert("reviews", review)
-
-        # Update restaurant's overall rating
-        rdb = RestaurantsDB()
-        restaurant = rdb.get_restaurant(restid=order['restid'])
-        if restaurant['numreviews'] > 0:
-            newrating = (restaurant['avgreview'] * restaurant['numreviews'] + stars) / (restaurant['numreviews'] + 1)
-        else:
-            newrating = stars
-        rdb.edit_restaurant(restaurant['userid'], **{'avgreview': round(newrating, 2), 'numreviews': restaurant['numreviews'] + 1})
+        if stars not in range(1, 6):
+            raise ValueError(f"A review must have 1 to 5 stars, not {stars}.")
+
+        with self._cursor(atomic=True) as cur:
+            # The buyer and restaurant are copied from the order by the database itself, rather than read beforehand
+            try:
+                cur.execute("INSERT INTO reviews (orderid, stars, title, description, submittedat, userid, restid) "
+                            "SELECT orderid, %s, %s, %s, %s, userid, restid FROM orders WHERE orderid = %s",
+                            [stars, title, description, time.time(), orderid])
+            except mysql.connector.IntegrityError:  # The unique key on orderid allows a single review per order
+                raise ValueError(f"Order {orderid} has already been reviewed.")
+            if cur.rowcount == 0:
+                raise ValueError(f"Order {orderid} does not exist.")
+            reviewid = cur.lastrowid
+
+            # Updated in place so that concurrent reviews cannot overwrite each other's changes. The assignments are
+            # applied left to right, so avgreview must come first to use the counts from before this review.
+            cur.execute(f"UPDATE restaurants SET avgreview = ROUND((totalstars + %s) / (numreviews + 1), 1), "
+                        f"numreviews = numreviews + 1, totalstars = totalstars + %s, stars{stars} = stars{stars} + 1 "
+                        f"WHERE restid = (SELECT restid FROM orders WHERE orderid = %s)", [stars, stars, orderid])
+            # The rating is part of the restaurant list, which every process must now reload
+            cur.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
 
         return reviewid
 
-    def fetch_rest_reviews(self, restid: int) -> list[dict]:
-        """ Fetches all reviews for a restaurant from the database.
+    def fetch_rest_reviews(self, restid: int, before: tuple[int, int] = None, limit: int = None) -> list[dict]:
+        """ Fetches the reviews for a restaurant from the database, a page at a time.
 
         Args:
             restid: The unique ID of the restaurant being queried.
+            before: The (submittedat, reviewid) of the last review of the previous page, or None for the first page.
+            limit: The maximum number of reviews to fetch, or None for all of them.
 
         Returns:
-            A list of dicts consisting of each review.
+            A list of dicts consisting of each review, newest first.
         """
-        reviews = self._select("reviews", ["*"], {"restid": restid})
+        page, params = self._page("submittedat", "reviewid", before, limit)
+        reviews = self._query("SELECT * FROM reviews WHERE restid = %s" + page, [restid] + params)
         return reviews
 
-    def fetch_user_reviews(self, userid: int) -> list[dict]:
-        """ Fetches all reviews by a user from the database.
+    def fetch_user_reviews(self, userid: int, before: tuple[int, int] = None, limit: int = None) -> list[dict]:
+        """ Fetches the reviews by a user from the database, a page at a time.
 
         Args:
             userid: The unique ID of the user being queried.
+            before: The (submittedat, reviewid) of the last review of the previous page, or None for the first page.
+            limit: The maximum number of reviews to fetch, or None for all of them.
 
         Returns:
-            A list of dicts consisting of each review.
+            A list of dicts consisting of each review, newest first.
         """
-        reviews = self._select("reviews", ["*"], {"userid": userid})
+        page, params = self._page("submittedat", "reviewid", before, limit)
+        reviews = self._query("SELECT * FROM reviews WHERE userid = %s" + page, [userid] + params)
         return reviews
 
     def fetch_review(self, reviewid: int) -> dict:
@@ -709,3 +1644,98 @@ class ReviewsDB(MySQL):
         """
         review = self._select("reviews", ["*"], {"reviewid": reviewid}, select_one=True)
         return review
+
+
+class EmailOutboxDB(MySQL):
+    """ Used to queue emails in the SQL Database, to be sent in the background """
+    def __init__(self):
+        super().__init__()  # Initialize database
+
+    def enqueue(self, subject: str, content: str, sender: str, receivers: list[str]) -> int:
+        """ Adds an email to the outbox.
+
+        Args:
+            subject: The subject of the email.
+            content: The HTML content of the email.
+            sender: The email address the email is sent from.
+            receivers: The email addresses the email is sent to.
+
+        Returns:
+            The unique ID of the queued email.
+        """
+        now = int(time.time())
+        email = {'createdat': now, 'subject': subject, 'content': content, 'sender': sender,
+                 'receivers': ",".join(receivers), 'nextattempt': now}
+        return self._insert("email_outbox", email)
+
+    def claim_batch(self, limit: int) -> list[dict]:
+        """ Claims a batch of emails which are due to be sent, so that no other worker sends them too.
+
+        Emails claimed by a worker which did not finish sending them within EMAIL_CLAIM_TIMEOUT are claimed again.
+
+        Args:
+            limit: The maximum number of emails to claim.
+
+        Returns:
+            A list of dicts consisting of each claimed email, with the receivers as a list.
+        """
+        claim = uuid.uuid4().hex
+        now = int(time.time())
+        with self._cursor() as cur:
+            cur.execute("UPDATE email_outbox SET status = 'Sending', claimedby = %s, claimedat = %s "
+                        "WHERE (status = 'Pending' AND nextattempt <= %s) OR (status = 'Sending' AND claimedat < %s) "
+                        "ORDER BY emailid LIMIT %s", (claim, now, now, now - EMAIL_CLAIM_TIMEOUT, limit))
+        emails = self._select("email_outbox", ["*"], {"claimedby": claim, "status": "Sending"})
+        for email in emails:
+            email['receivers'] = email['receivers'].split(",")
+        return emails
+
+    def mark_sent(self, emailid: int) -> None:
+        """ Marks an email as sent.
+
+        Args:
+            emailid: The unique ID of the email.
+        """
+        self._update("email_outbox", {"status": "Sent", "claimedby": None, "lasterror": None}, {"emailid": emailid})
+
+    def mark_failed(self, emailid: int, error: str) -> None:
+        """ Schedules a failed email to be retried with exponential backoff, or marks it as dead after too many attempts.
+
+        Args:
+            emailid: The unique ID of the email.
+            error: A description of why sending failed.
+        """
+        with self._cursor() as cur:
+            # MySQL applies the assignments from left to right, so status and nextattempt see the new attempts
+            cur.execute("UPDATE email_outbox SET attempts = attempts + 1, claimedby = NULL, lasterror = %s, "
+                        "status = IF(attempts >= %s, 'Dead', 'Pending'), "
+                        "nextattempt = %s + %s * POW(2, attempts - 1) "
+                        "WHERE emailid = %s",
+                        (error[:500], EMAIL_MAX_ATTEMPTS, int(time.time()), EMAIL_RETRY_DELAY, emailid))
+
+    def purge_sent(self, older_than: float, batch_size: int = 1000) -> int:
+        """ Deletes the emails which were sent successfully, so that the outbox does not grow forever.
+
+        Args:
+            older_than: Only delete emails queued before this unix timestamp.
+            batch_size: The maximum number of emails deleted per statement, to keep each delete short.
+
+        Returns:
+            The number of emails deleted.
+        """
+        deleted = 0
+        while True:
+            with self._cursor() as cur:
+                cur.execute("DELETE FROM email_outbox WHERE status = 'Sent' AND createdat < %s LIMIT %s",
+                            (int(older_than), batch_size))
+                deleted += cur.rowcount
+                if cur.rowcount < batch_size:
+                    return deleted
+
+    def fetch_dead(self) -> list[dict]:
+        """ Fetches all emails which could not be sent after EMAIL_MAX_ATTEMPTS attempts.
+
+        Returns:
+            A list of dicts consisting of each email.
+        """
+        return self._select("email_outbox", ["*"], {"status": "Dead"})
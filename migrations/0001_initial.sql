@@ -1,5 +1,3 @@
-CREATE DATABASE IF NOT EXISTS foodshare;
-
 CREATE TABLE IF NOT EXISTS `cart` (
   `userid` int(11) UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
   `restid` int(11) UNSIGNED NOT NULL,
@@ -0,0 +1,19 @@
+ALTER TABLE `users`
+  ADD UNIQUE KEY `users_email` (`email`),
+  ADD UNIQUE KEY `users_reset_id` (`reset_id`);
+
+ALTER TABLE `restaurants`
+  ADD UNIQUE KEY `restaurants_userid` (`userid`),
+  ADD KEY `restaurants_name` (`name`);
+
+ALTER TABLE `fooditems`
+  ADD KEY `fooditems_restid_inmenu` (`restid`, `inmenu`);
+
+ALTER TABLE `orders`
+  ADD KEY `orders_restid_ordertime` (`restid`, `ordertime`),
+  ADD KEY `orders_userid_ordertime` (`userid`, `ordertime`);
+
+ALTER TABLE `reviews`
+  ADD KEY `reviews_restid_submittedat` (`restid`, `submittedat`),
+  ADD KEY `reviews_userid_submittedat` (`userid`, `submittedat`),
+  ADD KEY `reviews_orderid` (`orderid`);
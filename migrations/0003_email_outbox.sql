@@ -0,0 +1,16 @@
+CREATE TABLE IF NOT EXISTS `email_outbox` (
+  `emailid` int(11) UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+  `createdat` bigint(20) NOT NULL,
+  `subject` varchar(200) NOT NULL,
+  `content` text NOT NULL,
+  `sender` varchar(100) NOT NULL,
+  `receivers` varchar(1000) NOT NULL,
+  `status` enum('Pending','Sending','Sent','Dead') NOT NULL DEFAULT 'Pending',
+  `attempts` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  `nextattempt` bigint(20) NOT NULL,
+  `claimedby` char(32) DEFAULT NULL,
+  `claimedat` bigint(20) DEFAULT NULL,
+  `lasterror` varchar(500) DEFAULT NULL,
+  KEY `email_outbox_status_nextattempt` (`status`, `nextattempt`),
+  KEY `email_outbox_claimedby` (`claimedby`)
+);
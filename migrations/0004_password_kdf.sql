@@ -0,0 +1,2 @@
+ALTER TABLE `users`
+  ADD COLUMN `kdf` varchar(100) NOT NULL DEFAULT 'pbkdf2_sha256$100000' AFTER `salt`;
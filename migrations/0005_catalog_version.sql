@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS `catalog_version` (
+  `id` tinyint(1) UNSIGNED NOT NULL PRIMARY KEY,
+  `version` bigint(20) UNSIGNED NOT NULL DEFAULT 0
+);
+
+INSERT IGNORE INTO `catalog_version` (`id`, `version`) VALUES (1, 0);
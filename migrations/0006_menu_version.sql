@@ -0,0 +1,2 @@
+ALTER TABLE `restaurants`
+  ADD COLUMN `menuversion` int(10) UNSIGNED NOT NULL DEFAULT 0;
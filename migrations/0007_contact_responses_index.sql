@@ -0,0 +1,2 @@
+ALTER TABLE `contactformresponses`
+  ADD KEY `contactformresponses_submittedat` (`submittedat`);
@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS `order_items` (
+  `orderid` int(11) UNSIGNED NOT NULL,
+  `itemid` int(11) UNSIGNED NOT NULL,
+  `name` varchar(100) NOT NULL,
+  `price` decimal(5,2) UNSIGNED NOT NULL,
+  `quantity` int(10) UNSIGNED NOT NULL,
+  `total` decimal(7,2) UNSIGNED NOT NULL,
+  PRIMARY KEY (`orderid`, `itemid`),
+  KEY `order_items_itemid` (`itemid`)
+);
@@ -0,0 +1,26 @@
+""" Copies the items of existing orders from the orders.items JSON column into the order_items table """
+
+# System imports:
+import json
+
+BATCH_SIZE = 1000
+
+
+def upgrade(cur):
+    last_orderid = 0
+    while True:
+        cur.execute("SELECT orderid, items FROM orders WHERE orderid > %s ORDER BY orderid LIMIT %s",
+                    (last_orderid, BATCH_SIZE))
+        orders = cur.fetchall()
+        if not orders:
+            break
+        lines = []
+        for orderid, items in orders:
+            for item in json.loads(items):
+                price = float(item['price'])
+                total = item.get('total', round(price * item['quantity'], 2))
+                lines.append((orderid, item['itemid'], item['name'], price, item['quantity'], total))
+        # IGNORE, so that a backfill interrupted part way can simply be run again
+        cur.executemany("INSERT IGNORE INTO order_items (orderid, itemid, name, price, quantity, total) "
+                        "VALUES (%s, %s, %s, %s, %s, %s)", lines)
+        last_orderid = orders[-1][0]
@@ -0,0 +1,29 @@
+CREATE TABLE IF NOT EXISTS `sales_daily` (
+  `restid` int(11) UNSIGNED NOT NULL,
+  `day` date NOT NULL,
+  `orders` int(10) NOT NULL DEFAULT 0,
+  `revenue` decimal(10,2) NOT NULL DEFAULT 0,
+  `collected` int(10) NOT NULL DEFAULT 0,
+  `cancellations` int(10) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`restid`, `day`)
+);
+
+CREATE TABLE IF NOT EXISTS `item_sales_daily` (
+  `restid` int(11) UNSIGNED NOT NULL,
+  `day` date NOT NULL,
+  `itemid` int(11) UNSIGNED NOT NULL,
+  `name` varchar(100) NOT NULL,
+  `units` int(10) NOT NULL DEFAULT 0,
+  `revenue` decimal(10,2) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`restid`, `day`, `itemid`)
+);
+
+INSERT INTO `sales_daily` (`restid`, `day`, `orders`, `revenue`, `collected`)
+  SELECT `restid`, DATE(FROM_UNIXTIME(`ordertime`)), COUNT(*), SUM(`amount`), SUM(`orderstatus` = 'Collected')
+  FROM `orders`
+  GROUP BY `restid`, DATE(FROM_UNIXTIME(`ordertime`));
+
+INSERT INTO `item_sales_daily` (`restid`, `day`, `itemid`, `name`, `units`, `revenue`)
+  SELECT o.`restid`, DATE(FROM_UNIXTIME(o.`ordertime`)), i.`itemid`, MAX(i.`name`), SUM(i.`quantity`), SUM(i.`total`)
+  FROM `orders` o JOIN `order_items` i ON i.`orderid` = o.`orderid`
+  GROUP BY o.`restid`, DATE(FROM_UNIXTIME(o.`ordertime`)), i.`itemid`;
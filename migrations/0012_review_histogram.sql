@@ -0,0 +1,16 @@
+ALTER TABLE `restaurants`
+  ADD COLUMN `totalstars` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  ADD COLUMN `stars1` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  ADD COLUMN `stars2` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  ADD COLUMN `stars3` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  ADD COLUMN `stars4` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  ADD COLUMN `stars5` int(10) UNSIGNED NOT NULL DEFAULT 0;
+
+UPDATE `restaurants` r
+  JOIN (SELECT `restid`, COUNT(*) AS n, SUM(`stars`) AS total, SUM(`stars` = 1) AS s1, SUM(`stars` = 2) AS s2,
+               SUM(`stars` = 3) AS s3, SUM(`stars` = 4) AS s4, SUM(`stars` = 5) AS s5
+        FROM `reviews` GROUP BY `restid`) v ON v.`restid` = r.`restid`
+  SET r.`numreviews` = v.n, r.`totalstars` = v.total, r.`avgreview` = ROUND(v.total / v.n, 1),
+      r.`stars1` = v.s1, r.`stars2` = v.s2, r.`stars3` = v.s3, r.`stars4` = v.s4, r.`stars5` = v.s5;
+
+UPDATE `catalog_version` SET `version` = `version` + 1 WHERE `id` = 1;
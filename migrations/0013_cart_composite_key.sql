@@ -0,0 +1,4 @@
+ALTER TABLE `cart`
+  MODIFY `userid` int(11) UNSIGNED NOT NULL,
+  DROP PRIMARY KEY,
+  ADD PRIMARY KEY (`userid`, `itemid`);
@@ -0,0 +1,3 @@
+DELETE c FROM `cart` c
+  LEFT JOIN `fooditems` f ON f.`itemid` = c.`itemid`
+  WHERE f.`itemid` IS NULL;
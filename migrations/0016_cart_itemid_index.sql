@@ -0,0 +1,2 @@
+ALTER TABLE `cart`
+  ADD KEY `cart_itemid` (`itemid`);
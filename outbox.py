@@ -0,0 +1,75 @@
+# System imports:
+import time
+import logging
+import threading
+
+# Local imports:
+from database import EmailOutboxDB
+from utils import Mailer
+from config import (EMAIL_BATCH_SIZE, EMAIL_POLL_INTERVAL, EMAIL_SMTP_IDLE_TIMEOUT, EMAIL_SENT_RETENTION,
+                    EMAIL_PURGE_INTERVAL)
+
+_wakeup = threading.Event()  # Set when an email is queued, so that the worker of this process sends it straight away
+
+
+def queue_email(subject: str, content: str, sender: str, receivers: list[str]) -> None:
+    """ Queues an email from the FoodShare email account, to be sent in the background """
+    EmailOutboxDB().enqueue(subject, content, sender, receivers)
+    _wakeup.set()
+
+
+class EmailWorker(threading.Thread):
+    """ Sends the emails in the outbox in batches over one long-lived SMTP connection """
+
+    def __init__(self, mailer: Mailer = None):
+        super().__init__(name="EmailWorker", daemon=True)
+        self.mailer = mailer or Mailer()
+        self.stopping = threading.Event()
+
+    def send_batch(self) -> int:
+        """ Claims and sends one batch of emails, scheduling a retry for each email that fails.
+
+        Returns:
+            The number of emails claimed.
+        """
+        db = EmailOutboxDB()
+        emails = db.claim_batch(EMAIL_BATCH_SIZE)
+        for email in emails:
+            try:
+                self.mailer.send(email['subject'], email['content'], email['sender'], email['receivers'])
+            except Exception as error:
+                logging.warning(f"Failed to send email #{email['emailid']}: {error!r}")
+                db.mark_failed(email['emailid'], repr(error))
+                self.mailer.close()  # Start the next email on a fresh connection
+            else:
+                db.mark_sent(email['emailid'])
+        return len(emails)
+
+    def run(self) -> None:
+        last_sent = time.monotonic()
+        last_purge = None
+        while not self.stopping.is_set():
+            try:
+                sent = self.send_batch()
+            except Exception:
+                logging.exception("Email worker failed to process the outbox")
+                sent = 0
+            if sent:
+                last_sent = time.monotonic()
+                continue  # There may be more emails waiting
+            if time.monotonic() - last_sent > EMAIL_SMTP_IDLE_TIMEOUT:
+                self.mailer.close()  # Don't hold the connection open while there is nothing to send
+            if last_purge is None or time.monotonic() - last_purge > EMAIL_PURGE_INTERVAL:
+                last_purge = time.monotonic()
+                try:
+                    EmailOutboxDB().purge_sent(time.time() - EMAIL_SENT_RETENTION)
+                except Exception:
+                    logging.exception("Email worker failed to delete old sent emails")
+            _wakeup.wait(EMAIL_POLL_INTERVAL)
+            _wakeup.clear()
+        self.mailer.close()
+
+    def stop(self) -> None:
+        """ Asks the worker to stop once it has finished its current batch """
+        self.stopping.set()
+        _wakeup.set()
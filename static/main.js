@@ -187,46 +187,85 @@ function notify(notification) {
   setTimeout(function(){ snackbar.className = snackbar.className.replace("show", ""); }, 3000);
 }
 
-/* For buyer_orders.html, seller_dashboard.html and restaurant.html */
+/* For restaurant.html */
+// Clicks on "+" and "-" are shown straight away, and sent to the server together once the user stops clicking
+let cartChanges = {}; // Change in quantity of each itemid not yet sent to the server
+let cartTimer = null;
+let cartRequests = 0; // Number of batches sent, so that only the response to the latest one updates the page
+
 updateCart = function (itemid, action) {
     let qtyField = document.getElementById(itemid.toString());
     if (qtyField.value == 0 && action == "decrement") {
                 notify("Invalid action.");
                 return; // Prevent decrement beyond 0
     }
-    $.ajax({
+    const delta = (action == 'increment') ? 1 : -1;
+    cartChanges[itemid] = (cartChanges[itemid] || 0) + delta;
+    qtyField.value = parseInt(qtyField.value) + delta;
+    clearTimeout(cartTimer);
+    cartTimer = setTimeout(sendCartChanges, 400);
+}
+
+// Shows the quantities in the cart on the server, along with any changes made since the batch was sent
+function showCart(cart) {
+    document.getElementsByName("quantity").forEach(function (qtyField) {
+        qtyField.value = (cart[qtyField.id] || 0) + (cartChanges[qtyField.id] || 0);
+    });
+}
+
+function sendCartChanges() {
+    const changes = cartChanges;
+    const request = ++cartRequests;
+    cartChanges = {};
+    return $.ajax({
         url: '/cart/update',
         type: 'POST',
-        data: {'itemid': itemid,
-               'action': action},
+        contentType: 'application/json',
+        data: JSON.stringify(changes),
         success: function (data) {
-        qtyField = document.getElementById(itemid.toString());
-        if (action == 'increment') {
-            if (qtyField.value == 0) {
-                notify("Item added to cart!");
-            }
-            else{
-                notify("Item quantity updated!");
-            }
-            qtyField.value++;
-        }
-        else if (action == 'decrement') {
-            if (qtyField.value == 1) {
-                notify("Item removed from cart!");
-            }
-            else{
-                notify("Item quantity updated!");
-            }
-            qtyField.value--;
+        if (request == cartRequests) {
+            showCart(data.cart);
         }
+        notify("Cart updated!");
     },
     error: function (data) {
+        if (request == cartRequests && data.responseJSON) {
+            showCart(data.responseJSON.cart);
+        }
         notify("Error updating cart. Please clear your cart of items from other restaurants before proceeding.");
     }
     }
    );
 }
 
+// Sends any changes not yet sent when the user leaves the page some other way (e.g. a link, the back button or closing
+// the tab). keepalive lets the request finish after the page has gone, which $.ajax cannot do.
+window.addEventListener('pagehide', function () {
+    clearTimeout(cartTimer);
+    if (Object.keys(cartChanges).length > 0) {
+        fetch('/cart/update', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(cartChanges),
+            keepalive: true
+        });
+        cartChanges = {};
+    }
+});
+
+// Sends any changes not yet sent before opening the cart, so that none of the user's last clicks are lost
+function proceedToCheckout() {
+    clearTimeout(cartTimer);
+    if (Object.keys(cartChanges).length > 0) {
+        sendCartChanges().always(function () {
+            window.open('/cart/view', '_self');
+        });
+    }
+    else {
+        window.open('/cart/view', '_self');
+    }
+}
+
 function cancelOrder(orderid) {
     $.ajax({
         url: '/orders/cancel',
@@ -1,89 +1,601 @@
 # System imports:
 import os
+import json
+import time
+import random
 import hashlib
+import hmac
+import multiprocessing
 import smtplib
+import sqlite3
 import ssl
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Union
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from functools import wraps
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 # Third-party imports:
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 
 # Local imports:
 from secret_config import ORS_API_KEY, EMAIL_ADDRESS, EMAIL_PASSWORD
+from config import (PASSWORD_KDF, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_DEPTH, SMTP_HOST, SMTP_PORT, SMTP_USE_SSL,
+                    SMTP_LOGIN, ORS_BASE_URL, ORS_MATRIX_MAX_LOCATIONS, ORS_MAX_CONCURRENT_REQUESTS,
+                    ORS_CONNECT_TIMEOUT, ORS_READ_TIMEOUT, ORS_MAX_RETRIES, ORS_BACKOFF, ORS_REQUEST_BUDGET,
+                    ORS_CIRCUIT_FAILURES, ORS_CIRCUIT_RESET, CACHE_PATH, CACHE_MAX_ENTRIES, CACHE_TTL,
+                    CACHE_COORDINATE_DECIMALS, AUTOCOMPLETE_RESULTS, AUTOCOMPLETE_INDEX_MAX_ENTRIES)
 
 
-def cache_data(func):
-    cached = {}
+class ORSUnavailableError(Exception):
+    """ Raised when the ORS API cannot be reached, or is not being contacted because it has been failing """
 
-    @wraps(func)
-    def decorator(*args):
-        # args[1:] is being used to exclude the first argument, 'self, which stores the object instance.
-        if args[1:] not in cached:
-            cached[args[1:]] = func(*args)
-            if len(cached) >= 256:  # If the cache is full, delete the oldest item to prevent memory overflow
-                cached.pop(next(iter(cached)))
-        return cached[args[1:]]
 
-    return decorator
+class LRUCache:
+    """ A thread-safe in-memory cache holding up to max_entries values, evicting the least recently used ones """
 
+    MISSING = object()  # Returned by get() when a key is not cached, since None can be a cached value
 
-def hash_password(password: str, salt: bytes = None) -> tuple[bytes, bytes]:
-    """ Takes in a password as a string and returns a randomly generated salt and the hash """
+    def __init__(self, max_entries: int, ttl: float = None):
+        self.max_entries = max_entries
+        self.ttl = ttl  # Seconds before an entry expires, None to keep entries until they are evicted
+        self._entries = OrderedDict()  # Key to (value, expiry time), least recently used first
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        """ Returns the value cached under a key, or LRUCache.MISSING if it is not cached or has expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                self._stats['misses'] += 1
+                return self.MISSING
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def set(self, key, value) -> None:
+        """ Caches a value under a key, evicting the least recently used entry if the cache is full """
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key) -> None:
+        """ Removes a key from the cache, if cached """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        """ Returns the number of entries, the hits, misses and evictions, and the hit rate """
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {'entries': len(self._entries), **self._stats,
+                    'hit_rate': self._stats['hits'] / lookups if lookups else 0.0}
+
+
+class PersistentCache:
+    """ A key-value cache stored in an SQLite file, so that it is shared by all worker processes and survives restarts.
+
+    Entries expire after their time-to-live, and the least recently used entries are evicted once the cache is full.
+    The size is only checked every EVICTION_INTERVAL writes, so the cache can briefly exceed max_entries by about that
+    many entries per process.
+    """
+
+    MISSING = object()  # Returned by get() when a key is not cached, since None can be a cached value
+    STATS_FLUSH_INTERVAL = 100  # Lookups counted in memory before the hit/miss counters are written to disk
+    EVICTION_INTERVAL = 100  # Writes by a process between checks of whether the cache is full
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()  # SQLite connections cannot be shared between threads
+        self._lock = threading.Lock()
+        self._pending = {'hits': 0, 'misses': 0, 'evictions': 0}  # Counts not yet written to disk
+        self._writes = 0  # Writes since the size of the cache was last checked
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Returns the SQLite connection of the current thread, opening it on first use (and again after a fork) """
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)  # Autocommit each statement
+            db.execute("PRAGMA journal_mode=WAL")  # Lets workers read while another one is writing
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                       "expires REAL NOT NULL, lastused REAL NOT NULL, PRIMARY KEY (namespace, key))")
+            db.execute("CREATE INDEX IF NOT EXISTS cache_lastused ON cache (lastused)")
+            db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def get(self, namespace: str, key: str):
+        """ Returns the value cached under a key, or PersistentCache.MISSING if it is not cached or has expired """
+        db = self._connection()
+        now = time.time()
+        row = db.execute("SELECT value, expires, lastused FROM cache WHERE namespace = ? AND key = ?",
+                         (namespace, key)).fetchone()
+        if row is None or row[1] < now:
+            self._count('misses')
+            return self.MISSING
+        if now - row[2] > 60:  # Recency only needs to be approximate, so avoid a write on every single hit
+            db.execute("UPDATE cache SET lastused = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+        self._count('hits')
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value, ttl: float = CACHE_TTL) -> None:
+        """ Caches a JSON-serialisable value under a key for ttl seconds, evicting old entries if the cache is full """
+        db = self._connection()
+        now = time.time()
+        db.execute("INSERT OR REPLACE INTO cache (namespace, key, value, expires, lastused) VALUES (?, ?, ?, ?, ?)",
+                   (namespace, key, json.dumps(value), now + ttl, now))
+        with self._lock:
+            self._writes += 1
+            if self._writes < self.EVICTION_INTERVAL:
+                return
+            self._writes = 0
+        self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """ Deletes expired entries, then the least recently used ones, until the cache is no longer over its size """
+        db = self._connection()
+        excess = db.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+        if excess > 0:
+            excess -= db.execute("DELETE FROM cache WHERE expires < ?", (now,)).rowcount  # Expired entries go first
+            if excess > 0:
+                evicted = db.execute("DELETE FROM cache WHERE rowid IN "
+                                     "(SELECT rowid FROM cache ORDER BY lastused LIMIT ?)", (excess,)).rowcount
+                self._count('evictions', evicted)
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        """ Counts a hit, miss or eviction, writing the counters to disk every so often """
+        with self._lock:
+            self._pending[name] += amount
+            flush = sum(self._pending.values()) >= self.STATS_FLUSH_INTERVAL
+        if flush:
+            self._flush_stats()
+
+    def _flush_stats(self) -> None:
+        """ Adds the counts made by this process to the counters stored on disk """
+        with self._lock:
+            pending, self._pending = self._pending, {name: 0 for name in self._pending}
+        self._connection().executemany(
+            "INSERT INTO stats (name, count) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET count = count + excluded.count",
+            [(name, count) for name, count in pending.items() if count])
+
+    def values(self, namespace: str) -> list:
+        """ Returns every value in a namespace which has not expired """
+        rows = self._connection().execute("SELECT value FROM cache WHERE namespace = ? AND expires >= ?",
+                                          (namespace, time.time())).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def stats(self) -> dict:
+        """ Returns the number of entries and the hits, misses and evictions counted across all processes """
+        self._flush_stats()
+        db = self._connection()
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        stats.update(db.execute("SELECT name, count FROM stats").fetchall())
+        stats['entries'] = db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return stats
+
+
+cache = PersistentCache(CACHE_PATH, CACHE_MAX_ENTRIES)
+
+
+def cache_key(*args) -> str:
+    """ Returns the cache key for a set of arguments, with coordinates rounded and addresses normalised """
+    def normalise(value):
+        if isinstance(value, (int, float)):  # Coordinates, which may also have been given as integers
+            return round(float(value), CACHE_COORDINATE_DECIMALS)
+        elif isinstance(value, str):
+            return " ".join(value.lower().split())
+        elif isinstance(value, (list, tuple)):
+            return [normalise(item) for item in value]
+        return value
+
+    return json.dumps(normalise(args))
+
+
+def cache_data(namespace: str, ttl: float = CACHE_TTL, fallback=None):
+    """ Decorator which caches the results of an ORS method in the persistent cache under the given namespace.
+
+    If ORS is unavailable and the result is not cached, the (uncached) result of fallback is returned instead, if given.
+    """
+    def wrapper(func):
+        @wraps(func)
+        def decorator(*args):
+            # args[1:] is being used to exclude the first argument, 'self, which stores the object instance.
+            key = cache_key(*args[1:])
+            result = cache.get(namespace, key)
+            if result is PersistentCache.MISSING:
+                try:
+                    result = func(*args)
+                except ORSUnavailableError:
+                    if fallback is None:
+                        raise
+                    return fallback(*args)
+                cache.set(namespace, key, result, ttl)
+            return result
+
+        return decorator
+
+    return wrapper
+
+
+class HashingBusyError(Exception):
+    """ Raised when too many passwords are already waiting to be hashed """
+
+
+def _derive_key(password: str, salt: bytes, kdf: str) -> bytes:
+    """ Internal function run in the hashing processes to hash a password with the KDF described by kdf """
+    name, *params = kdf.split("$")
+    if name == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac('sha256', password.encode("utf-8"), salt, int(params[0]))
+    elif name == "scrypt":
+        n, r, p = map(int, params)
+        return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=256 * r * (n + p + 1), dklen=64)
+    raise ValueError(f"Unknown KDF {kdf}")
+
+
+_hashing_pool = None
+_hashing_pool_pid = None
+_hashing_lock = threading.Lock()
+_hashing_slots = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_DEPTH)
+
+
+def _get_hashing_pool() -> ProcessPoolExecutor:
+    """ Returns the process pool used for hashing, creating it on first use (and again after a fork) """
+    global _hashing_pool, _hashing_pool_pid
+    with _hashing_lock:
+        if _hashing_pool is None or _hashing_pool_pid != os.getpid():
+            # Forking this process could copy a lock held by one of its other threads (e.g. the email worker) into the
+            # child, where it would never be released, so the hashing processes are forked from a clean server process
+            # instead. It only preloads this module, rather than re-importing the whole app.
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+            _hashing_pool = ProcessPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, mp_context=context)
+            _hashing_pool_pid = os.getpid()
+        return _hashing_pool
+
+
+def hash_password(password: str, salt: bytes = None, kdf: str = PASSWORD_KDF) -> tuple[bytes, bytes]:
+    """ Takes in a password as a string and returns the hash and a randomly generated salt (unless one is given).
+
+    The hashing is done in a separate process so that it does not hold up the web server.
+
+    Raises:
+        HashingBusyError: If PASSWORD_HASH_QUEUE_DEPTH passwords are already waiting to be hashed.
+    """
     if not salt:  # If salt is not specified
         salt = os.urandom(64)
 
     if len(salt) != 64:  # Validates function argument
         raise ValueError("Salt must be 64 characters")
 
-    hashed = hashlib.pbkdf2_hmac('sha256', password.encode("utf-8"), salt, 100000)
+    if not _hashing_slots.acquire(blocking=False):  # Turn away logins rather than let the backlog grow without bound
+        raise HashingBusyError("Too many passwords are waiting to be hashed.")
+    try:
+        hashed = _get_hashing_pool().submit(_derive_key, password, salt, kdf).result()
+    finally:
+        _hashing_slots.release()
     return hashed, salt
 
 
-def send_email(subject: str, content: str, sender: str, receivers: list[str]) -> None:
-    """ Sends an email from the FoodShare email account """
-    message = MIMEMultipart("alternative")
-    message["Subject"] = subject
-    message["From"] = sender
-    message["To"] = ",".join(receivers)
-    message.attach(MIMEText(content, "html"))
+def verify_password(password: str, hashed_password: bytes, salt: bytes, kdf: str) -> bool:
+    """ Returns whether a password matches a hash made with the given salt and KDF """
+    hashed, salt = hash_password(password, salt, kdf)
+    return hmac.compare_digest(hashed, hashed_password)
+
+
+def needs_rehash(kdf: str) -> bool:
+    """ Returns whether a hash made with the given KDF should be replaced by one made with the current PASSWORD_KDF """
+    return kdf != PASSWORD_KDF
+
+
+class Mailer:
+    """ Sends emails from the FoodShare email account over a single SMTP connection which is kept open between emails """
+
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, use_ssl: bool = SMTP_USE_SSL, login: bool = SMTP_LOGIN):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.login = login
+        self.server = None
+
+    def _connect(self) -> None:
+        """ Internal function to open and log in to the SMTP connection """
+        if self.use_ssl:
+            self.server = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context(), timeout=30)
+        else:
+            self.server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.login:
+            self.server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
+
+    def send(self, subject: str, content: str, sender: str, receivers: list[str]) -> None:
+        """ Sends an email, reconnecting once if the server has closed the connection since the last one """
+        message = MIMEMultipart("alternative")
+        message["Subject"] = subject
+        message["From"] = sender
+        message["To"] = ",".join(receivers)
+        message.attach(MIMEText(content, "html"))
+
+        if self.server is None:
+            self._connect()
+        try:
+            self.server.sendmail(sender, receivers, message.as_string())
+        except smtplib.SMTPServerDisconnected:
+            self._connect()
+            self.server.sendmail(sender, receivers, message.as_string())
+
+    def close(self) -> None:
+        """ Closes the SMTP connection, if open """
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except OSError:  # Includes SMTPException, e.g. if the server already dropped the connection
+                pass
+            self.server = None
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        server.sendmail(sender, ",".join(receivers), message.as_string())
+
+class DistanceIndex:
+    """ Stores the coordinates of many locations in columnar arrays to measure the distance to all of them at once """
+
+    EARTH_RADIUS = 6371008.8  # Mean radius of the Earth in metres
+
+    def __init__(self, coordinates: list[tuple[float, float]]):
+        """ Builds the index from a list of (longitude, latitude) coordinates """
+        coordinates = np.radians(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2))
+        self.longitudes = coordinates[:, 0].copy()
+        self.latitudes = coordinates[:, 1].copy()
+        self.cos_latitudes = np.cos(self.latitudes)
+
+    def __len__(self):
+        return len(self.longitudes)
+
+    def distances_from(self, coord: tuple[float, float]) -> np.ndarray:
+        """ Returns the straight-line (haversine) distance in metres from a coordinate to every indexed location """
+        longitude, latitude = np.radians(coord)
+        a = (np.sin((self.latitudes - latitude) / 2) ** 2
+             + np.cos(latitude) * self.cos_latitudes * np.sin((self.longitudes - longitude) / 2) ** 2)
+        return 2 * self.EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+    def nearest(self, coord: tuple[float, float], k: int = None) -> list[tuple[int, float]]:
+        """ Returns the (position, distance in metres) of the k nearest locations to a coordinate, nearest first.
+
+        Args:
+            coord: The (longitude, latitude) to measure from.
+            k: How many locations to return, or None for all of them.
+        """
+        distances = self.distances_from(coord)
+        if k is not None and k < len(distances):
+            positions = np.argpartition(distances, k)[:k]  # Only the k nearest need to be sorted
+            positions = positions[np.argsort(distances[positions])]
+        else:
+            positions = np.argsort(distances)
+        return [(int(position), float(distances[position])) for position in positions]
+
+
+class AddressIndex:
+    """ A sorted array of known addresses, which finds every address starting with a prefix using binary search """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._keys = []  # Normalised addresses, kept sorted
+        self._addresses = {}  # Normalised address to (address, coordinates)
+        self._lock = threading.Lock()
+        self._seeded = False
+
+    @staticmethod
+    def _normalise(address: str) -> str:
+        return " ".join(address.lower().split())
+
+    def add(self, address: str, coordinates: list[float, float]) -> None:
+        """ Adds an address and its coordinates to the index """
+        key = self._normalise(address)
+        with self._lock:
+            if key in self._addresses or len(self._keys) >= self.max_entries:
+                return
+            insort(self._keys, key)
+            self._addresses[key] = (address, coordinates)
+
+    def search(self, prefix: str, limit: int) -> dict[str, list[float, float]]:
+        """ Returns a dictionary mapping up to limit addresses starting with the prefix to their coordinates """
+        prefix = self._normalise(prefix)
+        results = {}
+        with self._lock:
+            position = bisect_left(self._keys, prefix)  # The first address which could start with the prefix
+            while position < len(self._keys) and len(results) < limit and self._keys[position].startswith(prefix):
+                address, coordinates = self._addresses[self._keys[position]]
+                results[address] = coordinates
+                position += 1
+        return results
+
+    def seed_once(self, addresses) -> None:
+        """ Adds the past autocomplete results and the given (address, coordinates) pairs, the first time it is called.
+
+        Args:
+            addresses: A function returning an iterable of (address, coordinates), e.g. of the addresses of restaurants.
+        """
+        with self._lock:
+            if self._seeded:
+                return
+            self._seeded = True
+        for locations in cache.values("autocomplete"):
+            for address, coordinates in locations.items():
+                self.add(address, coordinates)
+        for address, coordinates in addresses():
+            self.add(address, coordinates)
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls made with the same key, so that only the first one does the work """
+
+    def __init__(self):
+        self._calls = {}  # Key to the call in progress
+        self._lock = threading.Lock()
+
+    def run(self, key, func):
+        """ Returns func(), or the result of the identical call which is already in progress """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = func()
+            return call['result']
+        except Exception as error:
+            call['error'] = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+address_index = AddressIndex(AUTOCOMPLETE_INDEX_MAX_ENTRIES)
+_autocomplete_requests = SingleFlight()
+
+
+def autocomplete_address(address: str) -> dict[str, list[float, float]]:
+    """ Returns a dictionary mapping name to coordinates of suggestions for a partially typed address.
+
+    Suggestions come from the local index of known addresses when it has enough of them, and otherwise from ORS. Identical
+    lookups made at the same time share a single ORS request.
+    """
+    suggestions = address_index.search(address, AUTOCOMPLETE_RESULTS)
+    if len(suggestions) >= AUTOCOMPLETE_RESULTS:
+        return suggestions
+    locations = _autocomplete_requests.run(cache_key(address), lambda: ORS().autocomplete_coordinates(address))
+    for name, coordinates in locations.items():
+        address_index.add(name, coordinates)
+    return locations
+
+
+class CircuitBreaker:
+    """ Stops calls to a failing service for a while, so that requests fail fast instead of piling up on timeouts """
+
+    def __init__(self, max_failures: int, reset_timeout: float):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0  # Consecutive failures
+        self.opened_at = None  # When the circuit was opened, None while it is closed
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """ Returns whether a call may be attempted. Once the reset timeout has passed, one trial call is let through. """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.monotonic()  # Let this trial call through, but hold back the others
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """ Closes the circuit after a successful call """
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        """ Counts a failed call, opening the circuit if there have been too many in a row """
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+
+
+def straight_line_distance(coord1: tuple[float, float], coord2: tuple[float, float]) -> int:
+    """ Get the straight-line distance between two coordinates in metres as an integer, without using ORS """
+    return int(DistanceIndex([coord2]).distances_from(coord1)[0])
 
 
 class ORS:
     """ Used for accessing the Open Route Service API's methods """
 
-    def __init__(self):
+    breaker = CircuitBreaker(ORS_CIRCUIT_FAILURES, ORS_CIRCUIT_RESET)  # Shared by all instances in the process
+    _session = None
+    _session_pid = None
+    _session_lock = threading.Lock()
+
+    def __init__(self, base_link: str = ORS_BASE_URL):
         self.key = ORS_API_KEY
-        self.base_link = "https://api.openrouteservice.org"
+        self.base_link = base_link  # Can be pointed at a local stub server for testing
+
+    @classmethod
+    def _get_session(cls) -> requests.Session:
+        """ Returns the process-wide session, whose pooled keep-alive connections avoid a TLS handshake per request """
+        with cls._session_lock:
+            if cls._session is None or cls._session_pid != os.getpid():  # Sockets must not be shared with a fork
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=ORS_MAX_CONCURRENT_REQUESTS * 4)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                cls._session, cls._session_pid = session, os.getpid()
+            return cls._session
+
+    def _perform_request(self, method: str, endpoint: str, **kwargs):
+        """ Internal function to perform a request to the ORS API, retrying connection errors, 429s and 5xxs.
+
+        All attempts together are limited to ORS_REQUEST_BUDGET seconds, with the timeouts of the last attempt cut down
+        to whatever time is left, so that a slow ORS cannot hold up a page for longer than that.
+
+        Raises:
+            ORSUnavailableError: If every attempt failed, or ORS has been failing recently (the circuit is open).
+        """
+        if not self.breaker.allow():
+            raise ORSUnavailableError("ORS is temporarily not being contacted after repeated failures.")
+
+        deadline = time.monotonic() + ORS_REQUEST_BUDGET
+        for attempt in range(ORS_MAX_RETRIES + 1):
+            if attempt:  # Exponential backoff with full jitter, so that retries from many workers are spread out
+                time.sleep(random.uniform(0, ORS_BACKOFF * 2 ** (attempt - 1)))
+            remaining = deadline - time.monotonic()
+            if remaining <= ORS_CONNECT_TIMEOUT:  # Too little time left for another attempt to succeed
+                break
+            try:
+                response = self._get_session().request(
+                    method, self.base_link + endpoint,
+                    timeout=(ORS_CONNECT_TIMEOUT, min(ORS_READ_TIMEOUT, remaining - ORS_CONNECT_TIMEOUT)), **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                continue
+            self.breaker.record_success()
+            return response.json()
+
+        self.breaker.record_failure()
+        raise ORSUnavailableError(f"ORS request to {endpoint} failed within {ORS_REQUEST_BUDGET} seconds.")
 
     def _perform_get_request(self, endpoint: str, params: dict):
         """ Internal function to perform a get request to the ORS API given the endpoint and parameters """
-        return requests.get(
-            self.base_link + endpoint,
-            params={"api_key": self.key, **params}
-        ).json()
+        return self._perform_request("GET", endpoint, params={"api_key": self.key, **params})
 
     def _perform_post_request(self, endpoint: str, data: dict):
         """ Internal function to perform a post request to the ORS API given the endpoint and parameters """
-        return requests.post(
-            self.base_link + endpoint,
-            headers={"Authorization": self.key},
-            json=data
-        ).json()
+        return self._perform_request("POST", endpoint, headers={"Authorization": self.key}, json=data)
 
+    @cache_data("autocomplete", fallback=lambda self, address: {})
     def autocomplete_coordinates(self, address: str) -> dict[str, list[float, float]]:
         """ Returns a dictionary mapping name to coordinates of location results for a given address """
         result = self._perform_get_request(
             "/geocode/autocomplete",
             params={
                 'text': address,
-                'size': 5  # How many results we want
+                'size': AUTOCOMPLETE_RESULTS  # How many results we want
             }
         )
 
@@ -94,6 +606,7 @@ class ORS:
             locations[name] = coordinates
         return locations
 
+    @cache_data("geocode")
     def get_coordinates(self, address: str) -> list[float, float]:
         """ Returns coordinates (longitude and latitude) for a given address"""
         result = self._perform_get_request(
@@ -107,7 +620,7 @@ class ORS:
         # Returns only the coordinates
         return result['features'][0]['geometry']['coordinates']
 
-    @cache_data
+    @cache_data("distance", fallback=lambda self, coord1, coord2: straight_line_distance(coord1, coord2))
     def distance_between(self, coord1: tuple[float, float], coord2: tuple[float, float]) -> float:
         """ Get the distance between two coordinates in metres as an integer"""
         result = self._perform_post_request(
@@ -121,3 +634,46 @@ class ORS:
         distance = result['distances'][0][1] or result['distances'][1][0]
         
         return int(distance)
+
+    def distance_matrix(self, origin: tuple[float, float], destinations: list[tuple[float, float]]) -> list[Union[int, None]]:
+        """ Get the walking distance in metres from one coordinate to each of many others using the matrix endpoint.
+
+        Destinations are sent in as few requests as the API's per-request location limit allows, and the requests are
+        performed concurrently.
+
+        Returns:
+            The distance to each destination as an integer, in the same order, or None if it could not be routed to.
+        """
+        # Distances which are already cached (e.g. by distance_between) do not need to be requested again
+        distances = [cache.get("distance", cache_key(origin, destination)) for destination in destinations]
+        missing = [i for i, distance in enumerate(distances) if distance is PersistentCache.MISSING]
+
+        chunk_size = ORS_MATRIX_MAX_LOCATIONS - 1  # One location in each request is the origin
+        chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(len(chunks), ORS_MAX_CONCURRENT_REQUESTS)) as executor:
+                results = executor.map(
+                    lambda chunk: self._distance_matrix_chunk(origin, [destinations[i] for i in chunk]), chunks)
+                for chunk, result in zip(chunks, results):
+                    for i, distance in zip(chunk, result):
+                        distances[i] = distance
+                        if distance is not None:
+                            cache.set("distance", cache_key(origin, destinations[i]), distance)
+        return distances
+
+    def _distance_matrix_chunk(self, origin: tuple[float, float], destinations: list[tuple[float, float]]) -> list[Union[int, None]]:
+        """ Internal function to get the distances from one coordinate to a batch of others in a single request """
+        try:
+            result = self._perform_post_request(
+                "/v2/matrix/foot-walking",
+                data={
+                    'locations': [origin, *destinations],
+                    'sources': [0],
+                    'destinations': list(range(1, len(destinations) + 1)),
+                    'metrics': ["distance"],
+                    'units': "m"
+                }
+            )
+        except ORSUnavailableError:
+            return [None] * len(destinations)  # Callers keep their straight-line distances
+        return [int(distance) if distance is not None else None for distance in result['distances'][0]]